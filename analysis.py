@@ -0,0 +1,309 @@
+"""Integer-indexed views of the affects in graph's Context, for analysing them without walking its objects"""
+from array import array
+
+# The kinds of edge in an AffectGraph, one per type of affect in graph
+COMPLETE = 0
+OFFSET = 1
+CREATE_ACTION = 2
+CREATE_GROUP = 3
+KINDS = {
+    "complete": COMPLETE,
+    "offset": OFFSET,
+    "create_action": CREATE_ACTION,
+    "create_group": CREATE_GROUP,
+}
+
+
+def _compress(size, edges, source, target):
+    # Counting sort of the edges by their source into CSR arrays, keeping the order they're in for each source
+    offsets = array("l", [0]) * (size + 1)
+    for edge in edges:
+        offsets[edge[source] + 1] += 1
+    for node in range(size):
+        offsets[node + 1] += offsets[node]
+    free = array("l", offsets)
+    targets = array("l", [0]) * len(edges)
+    kinds = array("b", [0]) * len(edges)
+    on_complete = array("b", [0]) * len(edges)
+    for edge in edges:
+        slot = free[edge[source]]
+        free[edge[source]] += 1
+        targets[slot] = edge[target]
+        kinds[slot] = edge[2]
+        on_complete[slot] = edge[3]
+    return offsets, targets, kinds, on_complete
+
+
+class AffectGraph:
+    """The affects between actions and groups as arrays in compressed sparse row form
+
+    Every action gets a dense integer node id, numbered group by group, followed by a node for every group. Each
+    affect is an edge from the action causing it to the action it's on, or to the group for create group affects,
+    with one of the kinds above and whether it happens on the start or completion of the action. The edges from node
+    are targets[offsets[node]:offsets[node + 1]], with their kinds and on_complete in the same slots of those arrays,
+    and the edges to it are sources[in_offsets[node]:in_offsets[node + 1]] likewise.
+
+    It only holds ids, so it's looked up in Context to get back to the objects."""
+
+    def __init__(self, action_keys, group_ids, edges):
+        """action_keys are the (group id, action id) of each action in node order, which has to list the actions of
+        each group together in the order of group_ids. edges are (source, target, kind, on complete) tuples of the
+        action key of the source and the group id of the target for CREATE_GROUP or its action key otherwise. Edges to
+        actions or groups that aren't in the graph are left out"""
+        self.action_keys = action_keys
+        self.group_ids = group_ids
+        self.action_nodes = {key: node for node, key in enumerate(action_keys)}
+        self.group_nodes = {
+            group_id: len(action_keys) + i for i, group_id in enumerate(group_ids)
+        }
+        self.size = len(action_keys) + len(group_ids)
+        # The group node of every action node, and where each group's action nodes start, by group index
+        self.group_of = array("l", [self.group_nodes[g] for g, _ in action_keys])
+        self.first_action = array("l", [0]) * (len(group_ids) + 1)
+        for group_node in self.group_of:
+            self.first_action[group_node - len(action_keys) + 1] += 1
+        for i in range(len(group_ids)):
+            self.first_action[i + 1] += self.first_action[i]
+        node_edges = []
+        for source, target, kind, on_complete in edges:
+            targets = self.group_nodes if kind == CREATE_GROUP else self.action_nodes
+            if target in targets:
+                node_edges.append(
+                    (self.action_nodes[source], targets[target], kind, on_complete)
+                )
+        (self.offsets, self.targets, self.kinds, self.on_complete) = _compress(
+            self.size, node_edges, 0, 1
+        )
+        (self.in_offsets, self.sources, self.in_kinds, self.in_on_complete) = _compress(
+            self.size, node_edges, 1, 0
+        )
+
+    def with_edges_from(self, nodes):
+        """A graph of the same nodes with only the edges from nodes"""
+        edges = [
+            (self.key(node), self.key(target), kind, on_complete)
+            for node in sorted(set(nodes))
+            for target, kind, on_complete in self.edges_from(node)
+        ]
+        return AffectGraph(self.action_keys, self.group_ids, edges)
+
+    def is_group(self, node):
+        return node >= len(self.action_keys)
+
+    def key(self, node):
+        """The (group id, action id) of an action node or the group id of a group node"""
+        if self.is_group(node):
+            return self.group_ids[node - len(self.action_keys)]
+        return self.action_keys[node]
+
+    def actions_in(self, group_node):
+        """The action nodes of a group node's actions, in order"""
+        i = group_node - len(self.action_keys)
+        return range(self.first_action[i], self.first_action[i + 1])
+
+    def edges_from(self, node):
+        """(target, kind, on complete) for each edge from node"""
+        for slot in range(self.offsets[node], self.offsets[node + 1]):
+            yield self.targets[slot], self.kinds[slot], self.on_complete[slot]
+
+    def edges_to(self, node):
+        """(source, kind, on complete) for each edge to node"""
+        for slot in range(self.in_offsets[node], self.in_offsets[node + 1]):
+            yield self.sources[slot], self.in_kinds[slot], self.in_on_complete[slot]
+
+    def affected_action(self, node):
+        """The action node an edge to node affects, which is the group's first action for group nodes like in graph's
+        CreateGroupAffect, or None for a group without actions"""
+        if not self.is_group(node):
+            return node
+        actions = self.actions_in(node)
+        return actions[0] if actions else None
+
+
+def _next_nodes(graph, node, reverse):
+    # The nodes one affect away from node, or one affect back from it when reverse. Like in graph, creating a group
+    # leads to its first action
+    if reverse:
+        for source, _, _ in graph.edges_to(node):
+            yield source
+        if not graph.is_group(node):
+            group = graph.group_of[node]
+            if graph.affected_action(group) == node:
+                yield group
+    elif graph.is_group(node):
+        action = graph.affected_action(node)
+        if action is not None:
+            yield action
+    else:
+        for target, _, _ in graph.edges_from(node):
+            yield target
+
+
+def _postorder(graph, reverse):
+    # Every node after all the nodes it leads to that weren't already on the way to it, without recursing
+    order = []
+    seen = bytearray(graph.size)
+    for root in range(graph.size):
+        if seen[root]:
+            continue
+        seen[root] = 1
+        stack = [(root, _next_nodes(graph, root, reverse))]
+        while stack:
+            node, following = stack[-1]
+            for child in following:
+                if not seen[child]:
+                    seen[child] = 1
+                    stack.append((child, _next_nodes(graph, child, reverse)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def _bit_nodes(bits):
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class Closure:
+    """The nodes reachable from every node of an AffectGraph, or that reach it when reverse, as int bitsets
+
+    It's computed up front so reachable only has to OR bitsets together. That takes memory up to quadratic in the
+    number of nodes, so it's only worth keeping when there are many queries against the same graph."""
+
+    def __init__(self, graph, reverse=False):
+        self.reverse = reverse
+        order = _postorder(graph, reverse)
+        bits = [0] * graph.size
+        # Nodes come after everything they lead to, so a graph without cycles settles in one pass and each cycle
+        # only costs another
+        changed = True
+        while changed:
+            changed = False
+            for node in order:
+                reached = bits[node]
+                for following in _next_nodes(graph, node, reverse):
+                    reached |= (1 << following) | bits[following]
+                if reached != bits[node]:
+                    bits[node] = reached
+                    changed = True
+        self.bits = bits
+
+
+def reachable(graph, nodes, reverse=False, closure=None):
+    """The nodes reachable from any of nodes by following one or more affects, or that reach any of them when reverse
+
+    The starting nodes are only included if they're reached from one of them. Looked up in closure if it's given,
+    otherwise found by walking the graph. Returns the nodes in order."""
+    if closure is not None:
+        if closure.reverse != reverse:
+            raise ValueError("closure goes the other way")
+        bits = 0
+        for node in nodes:
+            bits |= closure.bits[node]
+        return list(_bit_nodes(bits))
+    reached = bytearray(graph.size)
+    stack = list(nodes)
+    while stack:
+        for following in _next_nodes(graph, stack.pop(), reverse):
+            if not reached[following]:
+                reached[following] = 1
+                stack.append(following)
+    return [node for node in range(graph.size) if reached[node]]
+
+
+def strongly_connected(graph):
+    """The strongly connected components of graph, each as a list of its nodes in order, found with Tarjan's algorithm
+    without recursing
+
+    Components come out in reverse topological order, so every component is after all the ones it leads to."""
+    index = array("l", [-1]) * graph.size
+    low = array("l", [0]) * graph.size
+    on_stack = bytearray(graph.size)
+    stack = []
+    components = []
+    count = 0
+    for root in range(graph.size):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = count
+        count += 1
+        stack.append(root)
+        on_stack[root] = 1
+        work = [(root, _next_nodes(graph, root, False))]
+        while work:
+            node, following = work[-1]
+            for child in following:
+                if index[child] == -1:
+                    index[child] = low[child] = count
+                    count += 1
+                    stack.append(child)
+                    on_stack[child] = 1
+                    work.append((child, _next_nodes(graph, child, False)))
+                    break
+                if on_stack[child] and index[child] < low[node]:
+                    low[node] = index[child]
+            else:
+                work.pop()
+                if work and low[node] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[node]
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    component.sort()
+                    components.append(component)
+    return components
+
+
+def cycles(graph, components=None):
+    """The components of graph that loop, which are the ones with more than one node or a node that affects itself
+
+    components are strongly_connected's for graph, to save finding them again."""
+    if components is None:
+        components = strongly_connected(graph)
+    return [
+        c for c in components if len(c) > 1 or c[0] in _next_nodes(graph, c[0], False)
+    ]
+
+
+def redundant_edges(graph, components=None):
+    """The (source, target) nodes of the edges of graph that a longer path already implies, which is what a transitive
+    reduction leaves out
+
+    A reduction is only unique without cycles, so this reduces the graph of strongly_connected's components. An edge
+    between two components is redundant when one of the other components its source leads to reaches its target's, and
+    edges inside a component are always kept. Leaving all the edges out doesn't change what reaches what in graph, so
+    graph should only have the edges that are going to be kept or left out, see with_edges_from."""
+    if components is None:
+        components = strongly_connected(graph)
+    component_of = array("l", [0]) * graph.size
+    for i, component in enumerate(components):
+        for node in component:
+            component_of[node] = i
+    # The components reachable from each one as bitsets, filled in as they come after the ones they lead to
+    reach = [0] * len(components)
+    implied = []
+    for i, component in enumerate(components):
+        following = {
+            component_of[child]
+            for node in component
+            for child in _next_nodes(graph, node, False)
+        }
+        following.discard(i)
+        for j in following:
+            reach[i] |= (1 << j) | reach[j]
+        implied.append({j for j in following for k in following if reach[k] >> j & 1})
+    redundant = set()
+    for node in range(graph.size):
+        for target, _, _ in graph.edges_from(node):
+            if component_of[target] in implied[component_of[node]]:
+                redundant.add((node, target))
+    return redundant
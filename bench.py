@@ -0,0 +1,364 @@
+"""Microbenchmarks for the hot paths of loading ResWare's action lists and turning them into graphs
+
+Run python bench.py [name ...] to run the named benchmarks or all of them if none are given. They only use synthetic
+data and local SQLite files, so they don't need ResWare's db."""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import (
+    _create_from_db,
+    index,
+    ConnectionPool,
+    ResWareDatabaseConnection,
+    SQLiteBackend,
+)
+from graph import (
+    _build_context,
+    _prune_affects_on_empty_groups,
+    build_action_list,
+    find_redundant_affects,
+    generate_condensed_digraph_from_action_list,
+    generate_digraph_from_action_list,
+)
+from resware_model import (
+    TABLES,
+    Action,
+    ActionEmail,
+    ActionEvent,
+    ActionList,
+    ActionListGroups,
+    DocumentType,
+    Email,
+    EmailDocument,
+    EmailPartnerRestriction,
+    EmailPartnerTypeRecipient,
+    EmailTemplate,
+    ExternalAction,
+    Group,
+    GroupAction,
+    GroupActionAffect,
+    GroupActionPartnerRestriction,
+    GroupPartnerRestriction,
+    Models,
+    Partner,
+    PartnerType,
+    PartnerTypes,
+    Task,
+    Template,
+    Trigger,
+)
+from seed import seed
+from snapshot import load_snapshot, save_snapshot
+
+# The action list synthetic_models puts every group in
+ACTION_LIST_ID = 1
+
+
+def _time(f):
+    start = time.perf_counter()
+    result = f()
+    return time.perf_counter() - start, result
+
+
+def _report(name, seconds, count):
+    print(f"  {name}: {seconds:.3f}s ({count / seconds:,.0f}/s)")
+
+
+def _email_row(i):
+    return {
+        "ActionEmailTemplateID": i,
+        "ActionEmailTemplateName": f"Email {i}",
+        "EmailSubject": f"Subject {i}",
+        "EmailBody": None if i % 3 else f"Body {i}",
+        "EmailAttachmentType": i % 4,
+        "GenerateHUD": False,
+        "GenerateBuyerStatement": False,
+        "CombineAsPDF": True,
+        "PDFName": None,
+        "PDFDocumentTypeID": None,
+        "ReplyToType": 1,
+        "TransmitViaXML": False,
+        "CombineGeneratedDocumentsAttachToEmail": False,
+    }
+
+
+def _affect_row(i):
+    return {
+        "AffectActionListGroupDefID": i % 500,
+        "AffectActionDefID": i,
+        "AffectActionTypeID": 1 + i % 2,
+        "AffectOffset": None if i % 2 else 24.0,
+        "AffectAutoComplete": bool(i % 2),
+        "CreateActionActionListGroupDefID": None,
+        "CreateActionActionDefID": None,
+        "CreateGroupActionListGroupDefID": None,
+        "ActionTypeID": 2,
+        "ActionListGroupDefID": i % 500,
+        "ActionDefID": i,
+    }
+
+
+def synthetic_models(groups=500, actions_per_group=5, empty_groups=0, seed=0):
+    """Creates Models shaped like a ResWare db with the given number of groups in action list ACTION_LIST_ID
+
+    Every action affects a couple of random actions, has an email, and some groups have triggers and partner
+    restrictions. empty_groups more groups without any actions are added, with some affects pointing at them. The
+    same arguments always produce the same Models."""
+    rand = random.Random(seed)
+    group_ids = list(range(1, groups + 1))
+    empty_group_ids = list(range(groups + 1, groups + empty_groups + 1))
+    action_ids = {g: [g * 100 + a for a in range(actions_per_group)] for g in group_ids}
+    rows = {name: [] for name in TABLES}
+    rows["action_lists"].append(ActionList(ACTION_LIST_ID, "Synthetic"))
+    rows["partner_types"] = [PartnerType(t, f"Partner Type {t}") for t in range(1, 6)]
+    rows["external_actions"] = [
+        ExternalAction(14, "File Created"),
+        ExternalAction(121, "Document Added"),
+        ExternalAction(154, "Received Action Event"),
+    ]
+    rows["action_events"] = [ActionEvent(1, "Event")]
+    rows["document_types"] = [DocumentType(d, f"Document {d}") for d in range(1, 21)]
+    rows["templates"] = [
+        Template(t, f"Template {t}", f"t{t}.docx", t) for t in range(1, 21)
+    ]
+    for p in range(1, 51):
+        rows["partners"].append(Partner(p, f"Partner {p}"))
+        rows["partners_types"].append(PartnerTypes(p, 1 + p % 5))
+    for order, g in enumerate(group_ids + empty_group_ids):
+        rows["groups"].append(Group(g, f"Group {g}"))
+        if g in action_ids:
+            rows["action_list_groups"].append(
+                ActionListGroups(ACTION_LIST_ID, g, order, g % 7 == 0)
+            )
+    for g in group_ids:
+        if g % 3 == 0:
+            rows["triggers"].append(
+                Trigger(
+                    g,
+                    action_ids[g][0],
+                    Task.START,
+                    None,
+                    True,
+                    None,
+                    None,
+                    None,
+                    121,
+                    g,
+                    None,
+                    1 + g % 20,
+                )
+            )
+        if g % 5 == 0:
+            rows["group_partner_restrictions"].append(
+                GroupPartnerRestriction(g, 1 + g % 50, True)
+            )
+        for a in action_ids[g]:
+            rows["actions"].append(Action(a, f"Action {a}", f"Action {a}", None, False))
+            rows["group_actions"].append(GroupAction(g, a, False))
+            for task in Task:
+                target = rand.choice(group_ids)
+                rows["group_action_affects"].append(
+                    GroupActionAffect(
+                        target,
+                        rand.choice(action_ids[target]),
+                        Task.START,
+                        None,
+                        True,
+                        None,
+                        None,
+                        None,
+                        task,
+                        g,
+                        a,
+                    )
+                )
+            if empty_group_ids and rand.random() < 0.1:
+                rows["group_action_affects"].append(
+                    GroupActionAffect(
+                        None,
+                        None,
+                        None,
+                        None,
+                        None,
+                        None,
+                        None,
+                        rand.choice(empty_group_ids),
+                        Task.COMPLETE,
+                        g,
+                        a,
+                    )
+                )
+            if a % 4 == 0:
+                rows["group_action_partner_restrictions"].append(
+                    GroupActionPartnerRestriction(g, a, 1 + a % 50, False)
+                )
+            rows["emails"].append(
+                Email(
+                    a,
+                    f"Email {a}",
+                    "Subject",
+                    "Body",
+                    0,
+                    False,
+                    False,
+                    False,
+                    None,
+                    None,
+                    1,
+                    False,
+                    False,
+                )
+            )
+            rows["action_emails"].append(ActionEmail(a, a, Task.COMPLETE))
+            rows["email_documents"].append(EmailDocument(a, 1 + a % 20))
+            rows["email_templates"].append(EmailTemplate(a, 1 + a % 20))
+            rows["email_partner_type_recipients"].append(
+                EmailPartnerTypeRecipient(a, 1 + a % 5)
+            )
+            rows["email_partner_restrictions"].append(
+                EmailPartnerRestriction(1 + a % 50, a, True)
+            )
+    return Models({name: index(TABLES[name], rows[name]) for name in TABLES})
+
+
+def bench_decode(count=300_000):
+    """Compares the compiled from_row decoders on tableclasses with the reflective _create_from_db on dict rows"""
+    for tablecls, make_row in [(Email, _email_row), (GroupActionAffect, _affect_row)]:
+        rows = [make_row(i) for i in range(count)]
+        print(f"decode {count:,} {tablecls.__name__} rows")
+        reflective, expected = _time(
+            lambda: [_create_from_db(tablecls, r) for r in rows]
+        )
+        _report("_create_from_db", reflective, count)
+        tuples = [tuple((r[c] for c in tablecls.columns)) for r in rows]
+        compiled, actual = _time(lambda: [tablecls.from_row(r) for r in tuples])
+        _report("from_row", compiled, count)
+        assert actual == expected
+        print(f"  {reflective / compiled:.1f}x faster")
+
+
+def bench_digraph(groups=3000):
+    """Times generating the action list's digraph with the node names and vertices being computed, then memoized"""
+    models = synthetic_models(groups)
+    ctx, alist = build_action_list(models, ACTION_LIST_ID)
+    print(f"digraph of {groups:,} groups")
+    cold, expected = _time(lambda: generate_digraph_from_action_list(alist))
+    print(f"  first generate_digraph_from_action_list: {cold:.3f}s")
+    warm, actual = _time(lambda: generate_digraph_from_action_list(alist))
+    print(f"  memoized generate_digraph_from_action_list: {warm:.3f}s")
+    assert actual == expected
+
+
+def bench_reduce(groups=3000):
+    """Times finding the affects other affects imply and counts the arrows left in the action list's digraph without
+    them, and with loops condensed"""
+    models = synthetic_models(groups)
+    ctx, alist = build_action_list(models, ACTION_LIST_ID)
+    print(f"reduce digraph of {groups:,} groups")
+    seconds, redundant = _time(lambda: find_redundant_affects(ctx, alist))
+    print(f"  find_redundant_affects: {seconds:.3f}s ({len(redundant):,} affects)")
+    for name, generate in [
+        ("full", lambda r: generate_digraph_from_action_list(alist, r)),
+        (
+            "condensed",
+            lambda r: generate_condensed_digraph_from_action_list(ctx, alist, r),
+        ),
+    ]:
+        arrows = generate(frozenset()).count(" -> ")
+        reduced = generate(redundant).count(" -> ")
+        print(f"  {name}: {arrows:,} arrows, {reduced:,} reduced")
+
+
+def bench_snapshot(groups=2000):
+    """Times saving and loading a snapshot of synthetic_models"""
+    models = synthetic_models(groups)
+    path = os.path.join(tempfile.mkdtemp(), "bench.snapshot")
+    print(f"snapshot of {groups:,} groups")
+    saved, _ = _time(lambda: save_snapshot(models, path))
+    print(f"  save: {saved:.3f}s, {os.path.getsize(path):,} bytes")
+    loaded, result = _time(lambda: load_snapshot(path))
+    print(f"  load: {loaded:.3f}s")
+    os.remove(path)
+    for name in TABLES:
+        assert getattr(result, name) == getattr(models, name), name
+
+
+def bench_sqlite(groups=2000):
+    """Times loading synthetic_models from a seeded SQLite db, building the graph, and generating its digraph"""
+    models = synthetic_models(groups)
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    seed(models, path)
+    backend = SQLiteBackend(path)
+    print(f"sqlite with {groups:,} groups")
+    with ResWareDatabaseConnection(backend) as conn:
+        loaded, result = _time(lambda: Models.from_db(conn))
+        print(f"  Models.from_db: {loaded:.3f}s")
+        scoped, _ = _time(lambda: Models.for_action_list(conn, ACTION_LIST_ID))
+        print(f"  Models.for_action_list: {scoped:.3f}s")
+    with ConnectionPool(4, backend) as pool:
+        parallel, _ = _time(lambda: Models.from_pool(pool))
+        print(f"  Models.from_pool with 4 connections: {parallel:.3f}s")
+    os.remove(path)
+    for name in TABLES:
+        assert getattr(result, name) == getattr(models, name), name
+    built, (_, alist) = _time(lambda: build_action_list(result, ACTION_LIST_ID))
+    print(f"  build_action_list: {built:.3f}s")
+    generated, _ = _time(lambda: generate_digraph_from_action_list(alist))
+    print(f"  generate_digraph_from_action_list: {generated:.3f}s")
+
+
+def _prune_quadratically(ctx):
+    # How build_action_list used to prune affects on empty groups, kept to compare against
+    for group in ctx.groups.values():
+        if len(group.actions) == 0 and len(group.triggers) == 0:
+            for possibly_referencing_group in ctx.groups.values():
+                if group == possibly_referencing_group:
+                    continue
+                for action in possibly_referencing_group.actions:
+                    for affect in action.start_affects[:]:
+                        if affect.group_id == group.id:
+                            action.start_affects.remove(affect)
+                    for affect in action.complete_affects[:]:
+                        if affect.group_id == group.id:
+                            action.complete_affects.remove(affect)
+
+
+def bench_prune(groups=5000, empty_groups=500):
+    """Compares pruning affects on empty groups in one pass with the old loop over every pair of groups"""
+    models = synthetic_models(groups, empty_groups=empty_groups)
+    print(
+        f"prune affects on {empty_groups:,} empty of {groups + empty_groups:,} groups"
+    )
+    expected = _build_context(models, ACTION_LIST_ID)
+    quadratic, _ = _time(lambda: _prune_quadratically(expected))
+    print(f"  pairwise: {quadratic:.3f}s")
+    actual = _build_context(models, ACTION_LIST_ID)
+    linear, _ = _time(lambda: _prune_affects_on_empty_groups(actual))
+    print(f"  one pass: {linear:.3f}s")
+    for key, action in expected.actions.items():
+        assert actual.actions[key].affects == action.affects, key
+    print(f"  {quadratic / linear:.1f}x faster")
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "digraph": bench_digraph,
+    "prune": bench_prune,
+    "reduce": bench_reduce,
+    "snapshot": bench_snapshot,
+    "sqlite": bench_sqlite,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(
+                f"Unknown benchmark {name}. Valid options are {', '.join(BENCHMARKS)}"
+            )
+            sys.exit(1)
+    for name in names:
+        BENCHMARKS[name]()
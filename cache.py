@@ -0,0 +1,181 @@
+"""In-process caches shared by the request handlers in web"""
+import collections
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StaleWhileRevalidate:
+    """Holds the latest result of build and rebuilds it in a background thread once it's older than ttl seconds
+
+    Callers always get the most recent complete result, even while a rebuild is running, so only the very first get
+    waits on build. build is passed the result it's replacing, or None on the first build."""
+
+    def __init__(self, build, ttl):
+        self.build = build
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._built_at = None
+        self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            if self._value is None:
+                self._value = self.build(None)
+                self._built_at = time.monotonic()
+            elif not self._refreshing and self._expired():
+                self._refreshing = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+            return self._value
+
+    def _expired(self):
+        return time.monotonic() - self._built_at >= self.ttl
+
+    def _refresh(self):
+        try:
+            value = self.build(self._value)
+        except Exception:
+            # Keep serving what we have and try again after another ttl rather than failing requests
+            logger.exception("Rebuild failed, continuing to serve the previous result")
+            value = self._value
+        with self._lock:
+            self._value = value
+            self._built_at = time.monotonic()
+            self._refreshing = False
+
+
+class BytesCache:
+    """Caches bytes by key in memory up to max_bytes, evicting the least recently used, and optionally in a directory
+
+    The directory can be shared by every process on a box, so something only has to be stored by one of them for all
+    of them to find it. Keys have to be usable as filenames and the same key must always have the same value."""
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Returns the bytes stored for key or None if there aren't any"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, key), "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.directory is not None:
+            # Write somewhere else and rename so no one ever reads a partial file
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(temp_path, os.path.join(self.directory, key))
+
+    def _remember(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function once for all the callers that ask for the same key while it's running
+
+    The callers that arrive while it's in flight wait for it and get its result or exception too. Once it's finished,
+    the next caller for the key runs it again, so this only coalesces concurrent work and doesn't cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        return flight, leader
+
+    def _land(self, key, flight, result=None, error=None):
+        # Only the first landing counts, since stream's can come from another thread before the leader finishes
+        with self._lock:
+            if flight.done.is_set():
+                return
+            del self._flights[key]
+            flight.result = result
+            flight.error = error
+            flight.done.set()
+
+    def do(self, key, f):
+        flight, leader = self._join(key)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        result = error = None
+        try:
+            result = f()
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._land(key, flight, result, error)
+
+    def stream(self, key, produce):
+        """Like do for a generator function that yields bytes, which is called with a function to land the flight
+
+        produce calls land with all of its bytes once it has them, from any thread and possibly before it's done
+        yielding them. The first caller gets each chunk as it's yielded. Callers that arrive before it lands get
+        everything as a single chunk once it does, so they don't wait for the first caller to finish iterating. If
+        produce raises or the first caller stops iterating before it lands, the others get the error or start over."""
+        flight, leader = self._join(key)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.result is None:
+                yield from self.stream(key, produce)
+            else:
+                yield flight.result
+            return
+        error = None
+        try:
+            yield from produce(lambda result: self._land(key, flight, result))
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._land(key, flight, error=error)
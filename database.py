@@ -1,37 +1,158 @@
 import collections
+import contextlib
+import enum
+import logging
+import queue
+import sqlite3
+import threading
 import pymssql
 
 from dataclasses import dataclass, field, fields
 
 from settings import (
+    RESWARE_DATABASE_BACKEND,
     RESWARE_DATABASE_NAME,
     RESWARE_DATABASE_PASSWORD,
     RESWARE_DATABASE_PORT,
     RESWARE_DATABASE_SERVER,
     RESWARE_DATABASE_USER,
+    RESWARE_SQLITE_PATH,
 )
 
+logger = logging.getLogger(__name__)
 
-class ResWareDatabaseConnection:
-    def __enter__(self):
-        self.connection = pymssql.connect(
+
+class MSSQLBackend:
+    """ResWare's own SQL Server db"""
+
+    # Whether load_many can send all its SELECTs in one batch
+    batches_statements = True
+    # Whether the db can tell us what's changed since a sync_token
+    tracks_changes = True
+    placeholder = "%s"
+
+    def connect(self):
+        return pymssql.connect(
             host=RESWARE_DATABASE_SERVER,
             user=RESWARE_DATABASE_USER,
             password=RESWARE_DATABASE_PASSWORD,
             port=RESWARE_DATABASE_PORT,
             database=RESWARE_DATABASE_NAME,
-            as_dict=True,
         )
+
+    def cursor(self, connection):
+        return connection.cursor()
+
+
+class SQLiteBackend:
+    """A local SQLite file standing in for ResWare's db with the tables from create_tables
+
+    seed.py fills one in from a snapshot"""
+
+    batches_statements = False
+    tracks_changes = False
+    placeholder = "?"
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # ConnectionPool hands connections to whichever thread asks for one next
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def cursor(self, connection):
+        # sqlite3 cursors can't be used with with on their own
+        return contextlib.closing(connection.cursor())
+
+
+def default_backend():
+    if RESWARE_DATABASE_BACKEND == "sqlite":
+        return SQLiteBackend(RESWARE_SQLITE_PATH)
+    if RESWARE_DATABASE_BACKEND == "mssql":
+        return MSSQLBackend()
+    raise Exception(
+        f"Unknown RESWARE_DATABASE_BACKEND {RESWARE_DATABASE_BACKEND}. Valid options are mssql and sqlite"
+    )
+
+
+class Connection:
+    """A connection to a backend's db whose cursors work with with and return rows as tuples"""
+
+    def __init__(self, backend, connection):
+        self.backend = backend
+        self.connection = connection
+
+    def cursor(self):
+        return self.backend.cursor(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class ResWareDatabaseConnection:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else default_backend()
+
+    def __enter__(self):
+        self.connection = Connection(self.backend, self.backend.connect())
         return self.connection
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.connection.close()
 
 
-def tableclass(table, lookup=None, one_to_many=False, **kwargs):
-    """Marks a dataclass as loadable from a specified SQL table"""
+class ConnectionPool:
+    """Hands out at most size ResWareDatabaseConnections at a time, reusing them across callers
+
+    Connections are opened as they're first needed and all closed when the pool is exited."""
+
+    def __init__(self, size, backend=None):
+        self.size = size
+        self.backend = backend
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._opened = contextlib.ExitStack()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Blocks until a connection is free and then yields it"""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    conn = self._opened.enter_context(
+                        ResWareDatabaseConnection(self.backend)
+                    )
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            self._opened.close()
+
 
-    def wrap(cls, lookup=lookup):
+def tableclass(
+    table, lookup=None, one_to_many=False, primary_key=None, where=None, **kwargs
+):
+    """Marks a dataclass as loadable from a specified SQL table
+
+    primary_key is the fieldname or tuple of fieldnames making up the table's primary key. It defaults to lookup if
+    one_to_many isn't set. With it, load can patch changed rows into a previous load rather than reading the table
+    again.
+
+    where filters the rows loaded from the table in the db. See _where_clause for what it can contain."""
+
+    def wrap(cls, lookup=lookup, primary_key=primary_key):
         dataclass(cls, **kwargs)
         cls.table = table
         if lookup is None:
@@ -52,21 +173,50 @@ def tableclass(table, lookup=None, one_to_many=False, **kwargs):
             def create_key(self):
                 return tuple((getattr(self, field) for field in lookup))
 
+        if primary_key is None and not one_to_many:
+            primary_key = lookup
+        if isinstance(primary_key, str):
+            primary_key = (primary_key,)
+        if primary_key is not None and one_to_many:
+            lookup_fields = (lookup,) if isinstance(lookup, str) else lookup
+            assert set(lookup_fields) <= set(
+                primary_key
+            ), f"The lookup on {cls} has to be part of its primary key to patch changes into it"
+
         cls.create_key = create_key
+        cls.columns = tuple((f.metadata["column"] for f in _column_fields(cls)))
+        cls.from_row = staticmethod(_compile_decoder(cls))
+        cls.lookup = lookup
         cls.one_to_many = one_to_many
+        cls.primary_key = primary_key
+        cls.where = where if where is not None else {}
         return cls
 
     return wrap
 
 
-def col(name, parser=None, nullable=False):
-    """Marks a tableclass field as coming rom the named column on the table of the tableclass"""
+def col(name, parser=None, nullable=False, serializer=None):
+    """Marks a tableclass field as coming rom the named column on the table of the tableclass
+
+    If there's a parser, serializer should undo it to get back the value for the column. insert uses it to write
+    instances back to a db."""
     metadata = {"column": name, "nullable": nullable}
     if parser:
         metadata["parser"] = parser
+    if serializer:
+        metadata["serializer"] = serializer
     return field(metadata=metadata)
 
 
+class _NotNull:
+    def __repr__(self):
+        return "NOT_NULL"
+
+
+# Use as the value for a column in a where to only load rows where the column isn't NULL
+NOT_NULL = _NotNull()
+
+
 class ColumnMissing(Exception):
     """Raised when the col for a field on a tableclass isn't in a fetched row"""
 
@@ -109,7 +259,265 @@ def _create_from_db(dclass, row):
     )
 
 
-def load(conn, tablecls):
+def _compile_decoder(dclass):
+    """Generates a function that creates an instance of dclass from a tuple of the values of its columns in order
+
+    The position, parser, and nullability of every field is baked into the generated code, so there's no reflection or
+    branching on field metadata per row. If anything goes wrong, it redoes the row with _create_from_db to raise the
+    same exception that would."""
+    namespace = {
+        "dclass": dclass,
+        "columns": tuple((f.metadata["column"] for f in _column_fields(dclass))),
+        "_create_from_db": _create_from_db,
+    }
+    statements = []
+    args = []
+    not_nulls = []
+    for i, f in enumerate(_column_fields(dclass)):
+        parser = f.metadata.get("parser", f.type)
+        if isinstance(parser, enum.EnumMeta):
+            # Calling an enum to look up its member is slow. Unknown values raise KeyError instead of ValueError,
+            # but either way we fall back to _create_from_db
+            namespace[f"parse{i}"] = parser._value2member_map_.__getitem__
+        else:
+            namespace[f"parse{i}"] = parser
+        statements.append(f"v{i} = row[{i}]")
+        if not f.metadata["nullable"]:
+            not_nulls.append(f"v{i} is None")
+            args.append(f"parse{i}(v{i})")
+        elif parser == f.type:
+            args.append(f"None if v{i} is None else parse{i}(v{i})")
+        else:
+            # Parsers that aren't the field type are responsible for NULL themselves
+            args.append(f"parse{i}(v{i})")
+    if not_nulls:
+        statements.append(f"if {' or '.join(not_nulls)}: raise ValueError()")
+    statements.append(f"return dclass({', '.join(args)})")
+    source = "\n".join(
+        ["def from_row(row):", "    try:"]
+        + [f"        {s}" for s in statements]
+        + [
+            "    except Exception:",
+            "        pass",
+            "    return _create_from_db(dclass, dict(zip(columns, row)))",
+        ]
+    )
+    exec(source, namespace)
+    from_row = namespace["from_row"]
+    from_row.__qualname__ = f"{dclass.__qualname__}.from_row"
+    return from_row
+
+
+def _column_fields(tablecls):
+    return [f for f in fields(tablecls) if "column" in f.metadata]
+
+
+def _empty_results(tablecls):
+    if tablecls.one_to_many:
+        return collections.defaultdict(list)
+    return {}
+
+
+def _key(tablecls, names, values):
+    """Creates the key for names on tablecls from a dict of fieldname to value"""
+    if isinstance(names, str):
+        return values[names]
+    return tuple((values[name] for name in names))
+
+
+def sync_token(conn):
+    """Returns the current change tracking version of the database or None if it doesn't have change tracking enabled
+
+    Pass it as since to a later load to only fetch what changed after this call."""
+    if not conn.backend.tracks_changes:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT CHANGE_TRACKING_CURRENT_VERSION()")
+        return cursor.fetchone()[0]
+
+
+def _tracks_changes_since(conn, tablecls, since):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID(%s))",
+            (tablecls.table,),
+        )
+        min_valid = cursor.fetchone()[0]
+    # NULL means change tracking isn't enabled on the table. If it's greater than since, the changes we need have
+    # already been cleaned up
+    return min_valid is not None and min_valid <= since
+
+
+def _has_changes(conn, tablecls, since):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT COUNT(*) FROM CHANGETABLE(CHANGES {tablecls.table}, %s) AS ct",
+            (since,),
+        )
+        return cursor.fetchone()[0] > 0
+
+
+def _load_changes(conn, tablecls, since):
+    """Returns the rows of tablecls changed since the given version as the change operation followed by the columns
+
+    The primary key columns come from the change table, so they're there for deleted rows too. If a row has been
+    deleted after the change we're getting, it's reported as a delete."""
+    pk_columns = [
+        f.metadata["column"]
+        for f in _column_fields(tablecls)
+        if f.name in tablecls.primary_key
+    ]
+    columns = ", ".join(
+        [
+            f"ct.{c}" if c in pk_columns else f"t.{c}"
+            for c in [f.metadata["column"] for f in _column_fields(tablecls)]
+        ]
+    )
+    join = " AND ".join([f"t.{c} = ct.{c}" for c in pk_columns])
+    query = (
+        f"SELECT CASE WHEN t.{pk_columns[0]} IS NULL THEN 'D' ELSE ct.SYS_CHANGE_OPERATION END, "
+        f"{columns} FROM CHANGETABLE(CHANGES {tablecls.table}, %s) AS ct "
+        f"LEFT JOIN {tablecls.table} AS t ON {join}"
+    )
+    with conn.cursor() as cursor:
+        cursor.execute(query, (since,))
+        return cursor.fetchall()
+
+
+def _patch(tablecls, previous, changes):
+    """Returns a copy of previous with changes applied to it, leaving previous untouched"""
+    results = _empty_results(tablecls)
+    results.update(previous)
+    pk_fields = [f for f in _column_fields(tablecls) if f.name in tablecls.primary_key]
+    copied = set()
+    for operation, *row in changes:
+        by_column = dict(zip(tablecls.columns, row))
+        values = {f.name: _parse_col(tablecls, f, by_column) for f in pk_fields}
+        key = _key(tablecls, tablecls.lookup, values)
+        instance = None
+        if operation != "D":
+            instance = tablecls.from_row(row)
+        if not tablecls.one_to_many:
+            if instance is None:
+                results.pop(key, None)
+            else:
+                results[key] = instance
+            continue
+        if key not in copied:
+            results[key] = list(results.get(key, []))
+            copied.add(key)
+        pk = _key(tablecls, tablecls.primary_key, values)
+        instances = [
+            i
+            for i in results[key]
+            if _key(tablecls, tablecls.primary_key, vars(i)) != pk
+        ]
+        if instance is not None:
+            instances.append(instance)
+        if instances:
+            results[key] = instances
+        else:
+            del results[key]
+    return results
+
+
+def _load_incrementally(conn, tablecls, since, previous):
+    """Returns previous updated to the current contents of the table or None if the table doesn't support that"""
+    try:
+        if not _tracks_changes_since(conn, tablecls, since):
+            return None
+        if tablecls.primary_key is None or tablecls.where:
+            # Without a primary key we can't tell which of the previous instances a change applies to, and the change
+            # table doesn't know about our where. We can still skip reading tables that haven't changed at all
+            return None if _has_changes(conn, tablecls, since) else previous
+        return _patch(tablecls, previous, _load_changes(conn, tablecls, since))
+    except pymssql.DatabaseError:
+        logger.warning(
+            "Fetching changes to %s failed, reloading it in full",
+            tablecls.table,
+            exc_info=True,
+        )
+        return None
+
+
+def _sql_literal(value):
+    # Only the types we filter on are supported. bool is checked first as it's an int
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise TypeError(f"Can't filter on {value!r} of type {type(value)}")
+
+
+def _where_clause(where):
+    """Creates a WHERE clause from a dict of column name to the value the column has to equal
+
+    If the value is a set, list, or tuple, the column has to equal one of the values in it. If it's NOT_NULL, the
+    column can have any value other than NULL."""
+    if not where:
+        return ""
+    conditions = []
+    for column, value in where.items():
+        if value is NOT_NULL:
+            conditions.append(f"{column} IS NOT NULL")
+        elif not isinstance(value, (set, frozenset, list, tuple)):
+            conditions.append(f"{column} = {_sql_literal(value)}")
+        elif value:
+            conditions.append(
+                f"{column} IN ({', '.join([_sql_literal(v) for v in value])})"
+            )
+        else:
+            # IN () isn't valid SQL, but nothing can be in an empty collection anyway
+            conditions.append("1 = 0")
+    return " WHERE " + " AND ".join(conditions)
+
+
+def _select(tablecls, where=None):
+    where = {**tablecls.where, **(where or {})}
+    return f"SELECT {', '.join(tablecls.columns)} FROM {tablecls.table}{_where_clause(where)}"
+
+
+def _add_rows(tablecls, results, rows):
+    _add_instances(tablecls, results, (tablecls.from_row(r) for r in rows))
+
+
+def index(tablecls, instances):
+    """Returns a dict of instances of tablecls keyed like load does it"""
+    results = _empty_results(tablecls)
+    _add_instances(tablecls, results, instances)
+    return results
+
+
+def _add_instances(tablecls, results, instances):
+    for instance in instances:
+        key = tablecls.create_key(instance)
+        if tablecls.one_to_many:
+            results[key].append(instance)
+        else:
+            assert (
+                key not in results
+            ), f"Was expecting a single item for {key} but got {instance} and {results[key]}"
+            results[key] = instance
+
+
+def _fetch_batches(cursor, batch_size):
+    """Yields the rows of the current result set on cursor batch_size at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+# How many rows load holds in memory at once
+LOAD_BATCH_SIZE = 1000
+
+
+def load(
+    conn, tablecls, since=None, previous=None, batch_size=LOAD_BATCH_SIZE, where=None
+):
     """Returns a dict of the lookup of tablecls to instances of it for all rows in its table
 
     If one_to_many is set on the tableclass, the returned dict will be from the key on the instance to a list of
@@ -118,25 +526,104 @@ def load(conn, tablecls):
     If lookup is specified, it's expected to be a fieldname or a tuple of fieldnames to create the keys for the returned
     dictionary
 
-    If lookup isn't specified, it's assumed to be 'id'"""
+    If lookup isn't specified, it's assumed to be 'id'
 
-    columns = ", ".join(
-        [f.metadata["column"] for f in fields(tablecls) if "column" in f.metadata]
-    )
-    query = f"SELECT {columns} FROM {tablecls.table}"
-    results = {}
-    if tablecls.one_to_many:
-        results = collections.defaultdict(list)
+    If since is a value from sync_token and previous is what load returned for tablecls at that point, only the rows
+    changed after since are fetched and a patched copy of previous is returned. That falls back to loading the full
+    table if change tracking isn't available for it or where is given.
+
+    If where is given, only the rows matching it and the where on tablecls are loaded. See _where_clause for what it
+    can contain.
+
+    Rows are fetched as tuples batch_size at a time and turned into instances as they arrive, so only a batch of raw
+    rows is held in memory alongside the returned dict."""
+
+    if since is not None and previous is not None and not where:
+        results = _load_incrementally(conn, tablecls, since, previous)
+        if results is not None:
+            return results
+
+    results = _empty_results(tablecls)
     with conn.cursor() as cursor:
-        cursor.execute(query)
-        for r in cursor.fetchall():
-            instance = _create_from_db(tablecls, r)
-            key = tablecls.create_key(instance)
-            if tablecls.one_to_many:
-                results[key].append(instance)
-            else:
-                assert (
-                    key not in results
-                ), f"Was expecting a single item for {key} but got {instance} and {results[key]}"
-                results[key] = instance
+        cursor.execute(_select(tablecls, where))
+        for rows in _fetch_batches(cursor, batch_size):
+            _add_rows(tablecls, results, rows)
         return results
+
+
+def load_many(conn, tableclasses, batch_size=LOAD_BATCH_SIZE, wheres=None):
+    """Returns a dict from each of tableclasses to what load would return for it
+
+    All the SELECTs are sent to the db in one batch and their result sets are read in order, so this only waits on a
+    single round trip no matter how many tableclasses there are.
+
+    wheres is an optional dict from tableclass to the where to load it with.
+
+    If the backend can't batch statements, this falls back to a load per tableclass."""
+    if wheres is None:
+        wheres = {}
+    if not conn.backend.batches_statements:
+        return {
+            t: load(conn, t, batch_size=batch_size, where=wheres.get(t))
+            for t in tableclasses
+        }
+    results = {}
+    with conn.cursor() as cursor:
+        cursor.execute(";\n".join([_select(t, wheres.get(t)) for t in tableclasses]))
+        for i, tablecls in enumerate(tableclasses):
+            if i > 0 and not cursor.nextset():
+                raise Exception(f"Expected a result set for {tablecls}")
+            results[tablecls] = _empty_results(tablecls)
+            for rows in _fetch_batches(cursor, batch_size):
+                _add_rows(tablecls, results[tablecls], rows)
+    return results
+
+
+# The SQLite column type for field types. Fields with a parser don't get a type as we don't know what the column holds
+_SQLITE_TYPES = {bool: "INTEGER", int: "INTEGER", float: "REAL", str: "TEXT"}
+
+
+def _column_type(f):
+    if "parser" in f.metadata or not isinstance(f.type, type):
+        return ""
+    for python_type, sql_type in _SQLITE_TYPES.items():
+        if issubclass(f.type, python_type):
+            return " " + sql_type
+    return ""
+
+
+def create_tables(conn, tableclasses):
+    """Creates the tables with the columns the tableclasses load from in a SQLite db if they don't exist"""
+    columns = collections.defaultdict(dict)
+    for tablecls in tableclasses:
+        for f in _column_fields(tablecls):
+            columns[tablecls.table][f.metadata["column"]] = _column_type(f)
+    with conn.cursor() as cursor:
+        for table, types in columns.items():
+            definitions = ", ".join([c + t for c, t in types.items()])
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} ({definitions})")
+    conn.commit()
+
+
+def _to_column(f, value):
+    if value is None:
+        return None
+    if "serializer" in f.metadata:
+        return f.metadata["serializer"](value)
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def insert(conn, tablecls, instances):
+    """Inserts rows for the instances of tablecls into its table"""
+    column_fields = _column_fields(tablecls)
+    placeholders = ", ".join([conn.backend.placeholder] * len(column_fields))
+    query = f"INSERT INTO {tablecls.table} ({', '.join(tablecls.columns)}) VALUES ({placeholders})"
+    rows = [
+        tuple([_to_column(f, getattr(i, f.name)) for f in column_fields])
+        for i in instances
+    ]
+    with conn.cursor() as cursor:
+        cursor.executemany(query, rows)
+    conn.commit()
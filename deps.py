@@ -40,9 +40,10 @@ class Vertex:
             )
         else:
             self._attrs = ""
+        self._line = f"{self.name}{self._attrs};"
 
     def __str__(self):
-        return f"{self.name}{self._attrs};"
+        return self._line
 
 
 def print_nodes_and_deps(to_visit, visited):
@@ -7,15 +7,45 @@ the instances should be immutable after build_action_list returns, but we're not
 
 import re
 import sys
+import threading
 
 from functools import wraps
-from typing import Iterable, List, Set, Tuple, Dict
+from typing import List, Optional, Tuple, Dict
 
 from dataclasses import asdict, dataclass, field, InitVar
 
+from analysis import (
+    CREATE_GROUP,
+    KINDS,
+    AffectGraph,
+    cycles,
+    reachable,
+    redundant_edges,
+)
 from deps import Vertex, escape_name
 from resware_model import Task, build_models, PartnerType
-from settings import ACTION_LIST_DEF_ID
+from settings import ACTION_LIST_DEF_ID, LOAD_ACTION_LIST_ONLY
+
+
+class _cached_property:
+    """functools.cached_property, which needs Python 3.8
+
+    Computes the property the first time it's read and stores it on the instance, where it's found before this on
+    every later read. We use it for the names and vertices of the graph's objects, which never change once
+    build_action_list returns, but are read many times for every digraph."""
+
+    def __init__(self, f):
+        self.f = f
+        self.__doc__ = f.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.f(instance)
+        return value
 
 
 def _node_name(*components):
@@ -47,6 +77,151 @@ class ActionLookupMixin(GroupLookupMixin):
 class Context:
     actions: Dict[Tuple[int, int], "Action"] = field(default_factory=dict)
     groups: Dict[int, "Group"] = field(default_factory=dict)
+    # Registries by id of the objects shared by everything in the graph that references them, so each is only built
+    # once. emails has the first Email built for each email definition, whose lists every other Email for it shares
+    partners: Dict[int, "Partner"] = field(default_factory=dict)
+    document_types: Dict[int, "DocumentType"] = field(default_factory=dict)
+    templates: Dict[int, "Template"] = field(default_factory=dict)
+    emails: Dict[int, "Email"] = field(default_factory=dict)
+    # Indexes of the (action, affect) pairs in every action's affects, filled in by build_action_list once the graph is
+    # complete. incoming_by_group is keyed by the affected group id and grouped by the group of the action causing the
+    # affect. outgoing_by_group is keyed by the group id of the action causing the affect and grouped by the affected
+    # group. The affects on each action are in affect_graph
+    incoming_by_group: Dict[
+        int, Dict["Group", List[Tuple["Action", "Affect"]]]
+    ] = field(default_factory=dict)
+    outgoing_by_group: Dict[
+        int, Dict["Group", List[Tuple["Action", "Affect"]]]
+    ] = field(default_factory=dict)
+    # The affects between every action and group in integer form, see analysis.AffectGraph
+    affect_graph: Optional[AffectGraph] = None
+
+    def incoming(self, group):
+        """The affects on group from actions in other groups, by the group of the action"""
+        return {
+            g: affects
+            for g, affects in self.incoming_by_group.get(group.id, {}).items()
+            if g != group
+        }
+
+    def outgoing(self, group):
+        """The affects of group's actions on other groups, by the affected group"""
+        return {
+            g: affects
+            for g, affects in self.outgoing_by_group.get(group.id, {}).items()
+            if g != group
+        }
+
+
+class _LazyDict(dict):
+    """A dict that calls build with a missing key under lock, which has to add it or raise KeyError"""
+
+    def __init__(self, lock, build):
+        super().__init__()
+        self._lock = lock
+        self._build = build
+
+    def __missing__(self, key):
+        with self._lock:
+            # Another thread may have built it while we waited
+            if not dict.__contains__(self, key):
+                self._build(key)
+            # dict.__getitem__ would call __missing__ again if build didn't add it
+            if not dict.__contains__(self, key):
+                raise KeyError(key)
+            return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class _EmptyGroups:
+    """Contains the ids of the groups in models that are empty, checking each id the first time it's asked about"""
+
+    def __init__(self, models):
+        self._models = models
+        self._checked = {}
+
+    def __contains__(self, group_id):
+        if group_id not in self._checked:
+            self._checked[group_id] = _is_empty_group(self._models, group_id)
+        return self._checked[group_id]
+
+
+class LazyContext(Context):
+    """A Context that builds each group, with its actions, emails, and triggers, the first time it's looked up
+
+    Looking up an action builds its group. The affect indexes are filled in per group from a reverse index of the raw
+    affects in models, so a group's page only builds the groups next to it. Affects on empty groups are left out as
+    each action is built rather than pruned afterwards. It's safe to use from multiple threads."""
+
+    def __init__(self, models, action_list_id):
+        lock = threading.RLock()
+        super().__init__(
+            actions=_LazyDict(lock, self._build_action_group),
+            groups=_LazyDict(lock, self._build_group),
+            incoming_by_group=_LazyDict(lock, self._index_incoming_by_group),
+            outgoing_by_group=_LazyDict(lock, self._index_outgoing_by_group),
+        )
+        self._models = models
+        self._nonoptional = set(
+            g.group_id
+            for g in models.action_list_groups[action_list_id]
+            if not g.optional
+        )
+        self._empty_groups = _EmptyGroups(models)
+        self.affect_graph = _build_affect_graph(models, self._empty_groups)
+        # Affected group id to the ids of the groups affecting it, and each group's position in models.groups to order
+        # them like build_action_list does. Built on the first incoming lookup
+        self._sources = None
+        self._order = None
+
+    def _build_group(self, group_id):
+        model_group = self._models.groups[group_id]
+        optional = group_id not in self._nonoptional
+        _build_group(self._models, model_group, optional, self, self._empty_groups)
+
+    def _build_action_group(self, key):
+        # Raises KeyError if the group is missing, otherwise it's added the action if the group has it
+        self.groups[key[0]]
+
+    def _index_sources(self):
+        if self._sources is not None:
+            return
+        sources = {}
+        for (group_id, _), affects in self._models.group_action_affects.items():
+            for affect in affects:
+                for affected in (
+                    affect.affected_group_id,
+                    affect.created_action_group_id,
+                    affect.created_group_id,
+                ):
+                    if affected is not None:
+                        sources.setdefault(affected, set()).add(group_id)
+        self._order = {group_id: i for i, group_id in enumerate(self._models.groups)}
+        self._sources = sources
+
+    def _index_incoming_by_group(self, group_id):
+        self._index_sources()
+        source_ids = [s for s in self._sources.get(group_id, ()) if s in self._order]
+        incoming = {}
+        for source_id in sorted(source_ids, key=self._order.__getitem__):
+            source = self.groups[source_id]
+            for action in source.actions:
+                for affect in action.affects:
+                    if affect.group_id == group_id:
+                        incoming.setdefault(source, []).append((action, affect))
+        dict.__setitem__(self.incoming_by_group, group_id, incoming)
+
+    def _index_outgoing_by_group(self, group_id):
+        outgoing = {}
+        for action in self.groups[group_id].actions:
+            for affect in action.affects:
+                outgoing.setdefault(affect.group, []).append((action, affect))
+        dict.__setitem__(self.outgoing_by_group, group_id, outgoing)
 
 
 @dataclass(unsafe_hash=True)
@@ -70,27 +245,39 @@ class Affect(CtxHolder, ActionLookupMixin):
 
 @dataclass(unsafe_hash=True)
 class AffectTaskAffect(Affect):
-    task: Task
+    task: Optional[Task]
+
+    @property
+    def task_name(self):
+        # AffectActionTypeID is nullable, so which task is affected isn't always known
+        return "UNKNOWN TASK" if self.task is None else self.task.name
 
 
 @dataclass(unsafe_hash=True)
 class CompleteActionAffect(AffectTaskAffect):
+    @property
+    def edge_kind(self):
+        # Drawn like completing the other task when it's unknown, since that's the plain arrow
+        return "complete" if self.task is None else self.task.name.lower()
+
     @property
     def affect(self):
-        return f"{self.task.name}"
+        return f"{self.task_name}"
 
     @property
     def desc(self):
-        return f"{self.task.name} {self.action.path}"
+        return f"{self.task_name} {self.action.path}"
 
 
 @dataclass(unsafe_hash=True)
 class OffsetActionAffect(AffectTaskAffect):
     offset: float
 
+    edge_kind = "offset"
+
     @property
     def affect(self):
-        return f"Offset {self.task.name} by {self.offset} hours"
+        return f"Offset {self.task_name} by {self.offset} hours"
 
     @property
     def desc(self):
@@ -99,6 +286,8 @@ class OffsetActionAffect(AffectTaskAffect):
 
 @dataclass(unsafe_hash=True)
 class CreateActionAffect(Affect):
+    edge_kind = "create"
+
     @property
     def affect(self):
         return "Create Action"
@@ -113,6 +302,8 @@ class CreateGroupAffect(CtxHolder, GroupLookupMixin):
     type: str
     group_id: int
 
+    edge_kind = "create"
+
     @property
     def affect(self):
         return "Create Group"
@@ -146,7 +337,7 @@ class ExternalAction:
     def label(self):
         return self.name
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.name, self.id)
 
@@ -154,7 +345,7 @@ class ExternalAction:
     def dot_attrs(self):
         return {"fillcolor": "#a6cee3", "style": "filled"}
 
-    @property
+    @_cached_property
     def vertex(self):
         return Vertex(self.label, name=self.node_name, **self.dot_attrs)
 
@@ -173,7 +364,7 @@ class DocumentAdded(ExternalAction):
     def label(self):
         return self.document.name + " Added"
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.document.name, self.id, self.document.id)
 
@@ -191,7 +382,7 @@ class ActionEventReceived(ExternalAction):
     def label(self):
         return "Event: " + self.action_event_name
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.action_event_name, self.id, self.action_event_id)
 
@@ -231,7 +422,7 @@ class Email(CtxHolder, ActionLookupMixin):
     required: List[Partner] = field(default_factory=list, compare=False)
     excluded: List[Partner] = field(default_factory=list, compare=False)
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.name, self.group_id, self.action_id)
 
@@ -239,7 +430,7 @@ class Email(CtxHolder, ActionLookupMixin):
     def dot_attrs(self):
         return {"fillcolor": "#33a02c", "style": "filled", "fontcolor": "white"}
 
-    @property
+    @_cached_property
     def vertex(self):
         return Vertex(self.name, name=self.node_name, **self.dot_attrs)
 
@@ -267,7 +458,7 @@ class Action(CtxHolder, GroupLookupMixin):
     required: List[Partner] = field(default_factory=list, compare=False)
     excluded: List[Partner] = field(default_factory=list, compare=False)
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.name, self.group_id, self.action_id)
 
@@ -279,7 +470,7 @@ class Action(CtxHolder, GroupLookupMixin):
     def affects(self):
         return self.start_affects + self.complete_affects
 
-    @property
+    @_cached_property
     def vertex(self):
         return Vertex(name_prefix.sub("", self.name), shape="box", name=self.node_name)
 
@@ -296,11 +487,11 @@ class Group:
     required: List[Partner] = field(default_factory=list, compare=False)
     excluded: List[Partner] = field(default_factory=list, compare=False)
 
-    @property
+    @_cached_property
     def node_name(self):
         return _node_name(self.name, self.id)
 
-    @property
+    @_cached_property
     def vertex(self):
         return Vertex(self.name, shape="octagon", name=self.node_name)
 
@@ -311,11 +502,10 @@ class ActionList:
     groups: List[Group] = field(default_factory=list, compare=False)
 
 
-def _build_external_action(models, model_trigger):
+def _build_external_action(models, model_trigger, ctx):
     name = models.external_actions[model_trigger.external_action_id].name
     if model_trigger.document_type_id is not None:
-        model_doc = models.document_types[model_trigger.document_type_id]
-        doc = DocumentType(model_doc.id, model_doc.name)
+        doc = _build_document_type(models, model_trigger.document_type_id, ctx)
         return DocumentAdded(model_trigger.external_action_id, name, doc)
     elif model_trigger.action_event_id is not None:
         ae = models.action_events[model_trigger.action_event_id]
@@ -357,14 +547,33 @@ def _build_affects(model_affect, ctx):
 
 
 def _build_triggers(models, model_trigger, ctx):
-    external_action = _build_external_action(models, model_trigger)
+    external_action = _build_external_action(models, model_trigger, ctx)
     for affect in _build_affects(model_trigger, ctx):
         yield Trigger(affect, external_action)
 
 
-def _build_document_type(models, document_type_id):
-    model_doc = models.document_types[document_type_id]
-    return DocumentType(model_doc.id, model_doc.name)
+def _intern(registry, key, build):
+    value = registry.get(key)
+    if value is None:
+        value = registry[key] = build()
+    return value
+
+
+def _build_document_type(models, document_type_id, ctx):
+    def build():
+        model_doc = models.document_types[document_type_id]
+        return DocumentType(model_doc.id, model_doc.name)
+
+    return _intern(ctx.document_types, document_type_id, build)
+
+
+def _build_template(models, template_id, ctx):
+    def build():
+        model_template = models.templates[template_id]
+        doc = _build_document_type(models, model_template.document_type_id, ctx)
+        return Template(model_template.name, model_template.filename, doc)
+
+    return _intern(ctx.templates, template_id, build)
 
 
 def _build_email(models, model_action_email, action, ctx):
@@ -378,15 +587,22 @@ def _build_email(models, model_action_email, action, ctx):
         model_email.body,
         model_action_email.task,
     )
+    shared = ctx.emails.get(model_email.id)
+    if shared is not None:
+        email.documents = shared.documents
+        email.templates = shared.templates
+        email.recipients = shared.recipients
+        email.required = shared.required
+        email.excluded = shared.excluded
+        return email
+    ctx.emails[model_email.id] = email
     for model_email_doc in models.email_documents[model_action_email.email_id]:
         email.documents.append(
-            _build_document_type(models, model_email_doc.document_type_id)
+            _build_document_type(models, model_email_doc.document_type_id, ctx)
         )
     for model_email_template in models.email_templates[model_action_email.email_id]:
-        model_template = models.templates[model_email_template.template_id]
-        doc = _build_document_type(models, model_template.document_type_id)
         email.templates.append(
-            Template(model_template.name, model_template.filename, doc)
+            _build_template(models, model_email_template.template_id, ctx)
         )
     for model_email_partner_type_recipient in models.email_partner_type_recipients[
         model_action_email.email_id
@@ -395,12 +611,15 @@ def _build_email(models, model_action_email, action, ctx):
             models.partner_types[model_email_partner_type_recipient.partner_type_id]
         )
     _add_partner_restrictions(
-        models, email, models.email_partner_restrictions[model_action_email.email_id]
+        models,
+        email,
+        models.email_partner_restrictions[model_action_email.email_id],
+        ctx,
     )
     return email
 
 
-def _build_action(models, model_group_action, ctx):
+def _build_action(models, model_group_action, ctx, empty_groups=()):
     model_action = models.actions[model_group_action.action_id]
     action = Action(
         ctx,
@@ -413,12 +632,14 @@ def _build_action(models, model_group_action, ctx):
         model_group_action.dynamic,
     )
     key = (action.group_id, action.action_id)
-    ctx.actions[key] = action
     for affect in models.group_action_affects[key]:
+        affects = [
+            a for a in _build_affects(affect, ctx) if a.group_id not in empty_groups
+        ]
         if affect.task == Task.START:
-            action.start_affects.extend(_build_affects(affect, ctx))
+            action.start_affects.extend(affects)
         if affect.task == Task.COMPLETE:
-            action.complete_affects.extend(_build_affects(affect, ctx))
+            action.complete_affects.extend(affects)
 
     for model_action_email in models.action_emails[action.action_id]:
         email = _build_email(models, model_action_email, action, ctx)
@@ -428,37 +649,54 @@ def _build_action(models, model_group_action, ctx):
             action.complete_emails.append(email)
 
     _add_partner_restrictions(
-        models, action, models.group_action_partner_restrictions[key]
+        models, action, models.group_action_partner_restrictions[key], ctx
     )
 
     return action
 
 
-def _add_partner_restrictions(models, restricted, restrictions):
+def _add_partner_restrictions(models, restricted, restrictions, ctx):
     for restriction in restrictions:
-        partner = _build_partner(models, models.partners[restriction.partner_id])
+        partner = _intern(
+            ctx.partners,
+            restriction.partner_id,
+            lambda: _build_partner(models, models.partners[restriction.partner_id]),
+        )
         if restriction.include:
             restricted.required.append(partner)
         else:
             restricted.excluded.append(partner)
 
 
-def _build_group(models, model_group, optional, ctx):
+def _build_group(models, model_group, optional, ctx, empty_groups=()):
+    """Builds a group and adds it and its actions to ctx, leaving out affects on the ids in empty_groups"""
     group = Group(model_group.id, model_group.name, optional)
-    ctx.groups[group.id] = group
     for model_group_action in models.group_actions[group.id]:
-        group.actions.append(_build_action(models, model_group_action, ctx))
+        group.actions.append(
+            _build_action(models, model_group_action, ctx, empty_groups)
+        )
     for model_trigger in models.triggers[group.id]:
         group.triggers.extend(_build_triggers(models, model_trigger, ctx))
     _add_partner_restrictions(
-        models, group, models.group_partner_restrictions[group.id]
+        models, group, models.group_partner_restrictions[group.id], ctx
     )
+    # Only add the group once it's complete, since a LazyContext can be read by other threads while it's building one
+    for action in group.actions:
+        ctx.actions[(action.group_id, action.action_id)] = action
+    ctx.groups[group.id] = group
     return group
 
 
-def build_action_list(models, action_list_id):
-    model_alist = models.action_lists[action_list_id]
+def _is_empty_group(models, group_id):
+    """Whether group_id is a group in models that build_action_list would build without any actions or triggers"""
+    if group_id not in models.groups or models.group_actions[group_id]:
+        return False
+    return not any(
+        any(True for _ in _build_affects(t, None)) for t in models.triggers[group_id]
+    )
+
 
+def _build_context(models, action_list_id):
     # Build the structure of all the groups, actions, affects, triggers, and emails
     ctx = Context()
 
@@ -473,22 +711,22 @@ def build_action_list(models, action_list_id):
     )
     for model_group in models.groups.values():
         _build_group(models, model_group, model_group.id not in nonoptional, ctx)
+    return ctx
 
-    # It's possible for a group to be completely empty. If that's the case, we'll never display
-    # it as it has no actions. Affects can still reference that empty group though. To keep from
-    # trying to display arrows to nowhere, remove those affects
-    for group in ctx.groups.values():
-        if len(group.actions) == 0 and len(group.triggers) == 0:
-            for possibly_referencing_group in ctx.groups.values():
-                if group == possibly_referencing_group:
-                    continue
-                for action in possibly_referencing_group.actions:
-                    for affect in action.start_affects[:]:
-                        if affect.group_id == group.id:
-                            action.start_affects.remove(affect)
-                    for affect in action.complete_affects[:]:
-                        if affect.group_id == group.id:
-                            action.complete_affects.remove(affect)
+
+def build_action_list(models, action_list_id, lazy=False):
+    """Builds the graph of every group in models and the action list with the groups directly in it
+
+    When lazy, only the action list's groups are built up front and the returned LazyContext builds the rest as
+    they're looked up."""
+    model_alist = models.action_lists[action_list_id]
+    if lazy:
+        ctx = LazyContext(models, action_list_id)
+    else:
+        ctx = _build_context(models, action_list_id)
+        _prune_affects_on_empty_groups(ctx)
+        _index_affects(ctx)
+        ctx.affect_graph = _build_affect_graph(models, _EmptyGroups(models))
 
     # Now that we have a clean set of groups, create the action list with the ordered list of
     # groups that are directly in it
@@ -499,6 +737,66 @@ def build_action_list(models, action_list_id):
     return ctx, result
 
 
+def _prune_affects_on_empty_groups(ctx):
+    # It's possible for a group to be completely empty. If that's the case, we'll never display
+    # it as it has no actions. Affects can still reference that empty group though. To keep from
+    # trying to display arrows to nowhere, remove those affects
+    empty = {
+        group.id
+        for group in ctx.groups.values()
+        if len(group.actions) == 0 and len(group.triggers) == 0
+    }
+    if not empty:
+        return
+    for action in ctx.actions.values():
+        action.start_affects = [
+            a for a in action.start_affects if a.group_id not in empty
+        ]
+        action.complete_affects = [
+            a for a in action.complete_affects if a.group_id not in empty
+        ]
+
+
+def _build_affect_graph(models, empty_groups):
+    # Built from the raw models the same way _build_group builds affects, so a LazyContext doesn't have to build every
+    # group for it
+    group_ids = list(models.groups)
+    action_keys = [
+        (group_id, model_group_action.action_id)
+        for group_id in group_ids
+        for model_group_action in models.group_actions[group_id]
+    ]
+    edges = []
+    for key in action_keys:
+        for model_affect in models.group_action_affects[key]:
+            if model_affect.task not in (Task.START, Task.COMPLETE):
+                continue
+            on_complete = model_affect.task == Task.COMPLETE
+            for affect in _build_affects(model_affect, None):
+                if affect.group_id in empty_groups:
+                    continue
+                kind = KINDS[affect.type]
+                if kind == CREATE_GROUP:
+                    target = affect.group_id
+                else:
+                    target = (affect.group_id, affect.action_id)
+                edges.append((key, target, kind, on_complete))
+    return AffectGraph(action_keys, group_ids, edges)
+
+
+def _index_affects(ctx):
+    for group in ctx.groups.values():
+        for action in group.actions:
+            for affect in action.affects:
+                pair = (action, affect)
+                ctx.incoming_by_group.setdefault(affect.group_id, {}).setdefault(
+                    group, []
+                ).append(pair)
+                ctx.outgoing_by_group.setdefault(group.id, {}).setdefault(
+                    affect.group, []
+                ).append(pair)
+
+
 def _build_partner(models, model_partner):
     partner = Partner(model_partner.id, model_partner.name)
     for model_partner_type in models.partners_types[partner.id]:
@@ -516,102 +814,256 @@ def build_partners(models):
 name_prefix = re.compile("^\w+: ")
 
 
-def _walk(action: Action, reachable: Set[Action]):
-    if action is None or action in reachable:
-        return
-    reachable.add(action)
-    for affect in action.start_affects:
-        _walk(affect.action, reachable)
-    for affect in action.complete_affects:
-        _walk(affect.action, reachable)
+# The dot attributes of the arrows for each edge_kind of affect. Completing the other task is the most common, so it's
+# left plain
+EDGE_STYLES = {
+    "complete": "",
+    "start": '[color="#1f78b4"]',
+    "offset": '[style="dashed", color="#ff7f00"]',
+    "create": '[style="bold", arrowhead="empty"]',
+}
+
+
+def _digraph_lines(objs):
+    yield "digraph G {"
+    # Actions often affect the same action more than one way, and the same vertex comes up more than once, which leads
+    # to dupes, so filter them out here. Edges are checked by their (from, to) or (from, to, edge kind) tuple rather
+    # than formatting every one first, so an arrow is only repeated for affects of different kinds
+    yielded = set()
+    for obj in objs:
+        edge = isinstance(obj, tuple)
+        key = obj if edge else str(obj)
+        if key in yielded:
+            continue
+        yielded.add(key)
+        if not edge:
+            yield key
+        elif len(obj) == 2:
+            yield f"{obj[0]} -> {obj[1]}"
+        else:
+            yield f"{obj[0]} -> {obj[1]}{EDGE_STYLES[obj[2]]}"
+    yield "}"
+
+
+def _encode_lines(lines, chunk_size=64 * 1024):
+    # Joins the lines exactly like the digraph string does, but in chunks of about chunk_size characters
+    batch = []
+    size = 0
+    separator = ""
+    for line in lines:
+        batch.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield (separator + "\n".join(batch)).encode("utf-8")
+            separator = "\n"
+            batch = []
+            size = 0
+    if batch:
+        yield (separator + "\n".join(batch)).encode("utf-8")
 
 
 def digraph(f):
+    """Makes a generator of Vertexes and edges into a function returning a dot digraph of them. Edges are (from, to)
+    node names, with the edge_kind of the affect they're drawn for after them if they're for one
+
+    The decorated function's chunks attribute takes the same arguments and yields the same digraph as utf-8 bytes while
+    it's generated, for feeding it to dot without holding all of it."""
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        lines = ["digraph G {"]
-        yielded = set()
-        for obj in f(*args, **kwargs):
-            # We're not distinguishing offset vs start vs complete affects in the arrows yet. That leads to dupe arrows, so
-            # filter them out here
-            line = str(obj)
-            if line in yielded:
-                continue
-            yielded.add(line)
-            lines.append(line)
-        lines.append("}")
-        return "\n".join(lines)
+        return "\n".join(_digraph_lines(f(*args, **kwargs)))
 
+    def chunks(*args, **kwargs):
+        return _encode_lines(_digraph_lines(f(*args, **kwargs)))
+
+    decorated_function.chunks = chunks
     return decorated_function
 
 
-def find_incoming(groups: Iterable[Group], group: Group):
-    incoming_group = set()
-    incoming_action = set()
-    for g in groups:
-        if g == group:
-            continue
-        for act in g.actions:
-            for aff in act.affects:
-                if aff.group == group:
-                    if aff.type == "create_group":
-                        incoming_group.add(g)
-                    elif aff.action is not None:
-                        incoming_action.add((g, aff.action))
-    return incoming_group, incoming_action
+def find_incoming(ctx: Context, group: Group):
+    """The other groups with actions that create group, and the (group, action) pairs of the actions in group affected
+    by other groups' actions with the group causing it, both in the order of ctx.affect_graph's nodes"""
+    graph = ctx.affect_graph
+    group_node = graph.group_nodes[group.id]
+    # Collected as node ids in dicts to dedupe them in order without hashing the objects
+    incoming_group = {}
+    for source, _, _ in graph.edges_to(group_node):
+        source_group = graph.group_of[source]
+        if source_group != group_node:
+            incoming_group[source_group] = None
+    incoming_action = {}
+    for action_node in graph.actions_in(group_node):
+        for source, _, _ in graph.edges_to(action_node):
+            source_group = graph.group_of[source]
+            if source_group != group_node:
+                incoming_action[(source_group, action_node)] = None
+    return (
+        [ctx.groups[graph.key(g)] for g in incoming_group],
+        [
+            (ctx.groups[graph.key(g)], ctx.actions[graph.key(a)])
+            for g, a in incoming_action
+        ],
+    )
 
 
 @digraph
-def generate_digraph_from_group(groups: Iterable[Group], group: Group):
-    incoming_group, incoming_action = find_incoming(groups, group)
+def generate_digraph_from_group(ctx: Context, group: Group):
+    incoming_group, incoming_action = find_incoming(ctx, group)
     if len(incoming_group) > 0:
         for g in incoming_group:
             yield g.vertex
         yield group.vertex
         for g in incoming_group:
-            yield f"{g.node_name} -> {group.node_name}"
+            yield g.node_name, group.node_name
     for g, _ in incoming_action:
         yield g.vertex
     for _, act in incoming_action:
         yield act.vertex
     for g, act in incoming_action:
-        yield f"{g.node_name} -> {act.node_name}"
+        yield g.node_name, act.node_name
     for trigger in group.triggers:
         if trigger.affect.action.group != group:
             continue
         yield trigger.external_action.vertex
-        yield f"{trigger.external_action.node_name} -> {trigger.affect.action.node_name}"
+        yield _affect_edge(trigger.external_action, trigger.affect)
     for action in group.actions:
         yield action.vertex
         for affect in action.start_affects + action.complete_affects:
             if affect.action.group != group:
                 continue
-            yield f"{action.node_name} -> {affect.action.node_name}"
+            yield _affect_edge(action, affect)
         for email in action.start_emails + action.complete_emails:
             yield email.vertex
-            yield f"{action.node_name} -> {email.node_name}"
+            yield action.node_name, email.node_name
 
     for act in group.actions:
         for aff in act.affects:
             if aff.group != group:
                 yield aff.group.vertex
-                yield f"{act.node_name} -> {aff.group.node_name}"
+                yield act.node_name, aff.group.node_name
+
+
+def _affect_edge(cause, affect):
+    return cause.node_name, affect.action.node_name, affect.edge_kind
+
+
+def _affect_key(action, affect):
+    # The (source, target) keys in ctx.affect_graph of the edge for affect
+    if affect.type == "create_group":
+        target = affect.group_id
+    else:
+        target = (affect.group_id, affect.action_id)
+    return (action.group_id, action.action_id), target
+
+
+def find_redundant_affects(ctx: Context, action_list: ActionList):
+    """The (source, target) keys in ctx.affect_graph of the affects of action_list's actions that longer chains of
+    them already imply, as found by analysis.redundant_edges
+
+    Only the affects drawn for action_list count as chains, so leaving these out of its digraph keeps what leads to
+    what in it, with fewer arrows for dot to lay out."""
+    graph = ctx.affect_graph.with_edges_from(
+        ctx.affect_graph.action_nodes[(action.group_id, action.action_id)]
+        for group in action_list.groups
+        for action in group.actions
+    )
+    return {
+        (graph.key(source), graph.key(target))
+        for source, target in redundant_edges(graph)
+    }
 
 
 @digraph
-def generate_digraph_from_action_list(action_list: ActionList):
+def generate_digraph_from_action_list(action_list: ActionList, redundant=frozenset()):
+    """redundant is find_redundant_affects's keys for the affects to leave out"""
     for group in action_list.groups:
         for trigger in group.triggers:
             yield trigger.external_action.vertex
-            yield f"{trigger.external_action.node_name} -> {trigger.affect.action.node_name}"
+            yield _affect_edge(trigger.external_action, trigger.affect)
 
         for action in group.actions:
             yield action.vertex
             for affect in action.start_affects + action.complete_affects:
-                yield f"{action.node_name} -> {affect.action.node_name}"
+                if _affect_key(action, affect) not in redundant:
+                    yield _affect_edge(action, affect)
             for email in action.start_emails + action.complete_emails:
                 yield email.vertex
-                yield f"{action.node_name} -> {email.node_name}"
+                yield action.node_name, email.node_name
+
+
+def find_cycles(ctx: Context) -> List[List[Action]]:
+    """The loops of affects in ctx, each as the actions in it in the order of ctx.affect_graph's nodes
+
+    Each loop is a strongly connected component of the actions, so all of them can eventually affect all the others,
+    and loops come after the loops they affect."""
+    graph = ctx.affect_graph
+    return [
+        [ctx.actions[graph.key(n)] for n in loop if not graph.is_group(n)]
+        for loop in cycles(graph)
+    ]
+
+
+# How many of a loop's actions are named on its node in condensed digraphs
+LOOP_LABEL_ACTIONS = 12
+
+
+def _loop_vertices(ctx: Context):
+    # A Vertex standing in for each loop in ctx, by the action node of each action in it
+    graph = ctx.affect_graph
+    vertices = {}
+    for loop in find_cycles(ctx):
+        # Only some of a big loop's actions fit in a node, the cycles action lists all of them
+        names = [name_prefix.sub("", a.name) for a in loop[:LOOP_LABEL_ACTIONS]]
+        if len(loop) > LOOP_LABEL_ACTIONS:
+            names.append(f"and {len(loop) - LOOP_LABEL_ACTIONS} more")
+        names = "\\n".join(names)
+        vertex = Vertex(
+            f"Loop of {len(loop)} actions\\n{names}",
+            name="loop_" + loop[0].node_name,
+            shape="box3d",
+        )
+        for action in loop:
+            vertices[graph.action_nodes[(action.group_id, action.action_id)]] = vertex
+    return vertices
+
+
+@digraph
+def generate_condensed_digraph_from_action_list(
+    ctx: Context, action_list: ActionList, redundant=frozenset()
+):
+    """generate_digraph_from_action_list with each loop of affects drawn as one node, and the affects inside it left
+    out, so dot doesn't have to lay the loops out"""
+    graph = ctx.affect_graph
+    loops = _loop_vertices(ctx)
+
+    def vertex(action):
+        return loops.get(graph.action_nodes[(action.group_id, action.action_id)])
+
+    def node_name(action):
+        loop = vertex(action)
+        return action.node_name if loop is None else loop.name
+
+    for group in action_list.groups:
+        for trigger in group.triggers:
+            affect = trigger.affect
+            yield trigger.external_action.vertex
+            yield (
+                trigger.external_action.node_name,
+                node_name(affect.action),
+                affect.edge_kind,
+            )
+
+        for action in group.actions:
+            loop = vertex(action)
+            yield action.vertex if loop is None else loop
+            for affect in action.start_affects + action.complete_affects:
+                if loop is not None and vertex(affect.action) is loop:
+                    continue
+                if _affect_key(action, affect) not in redundant:
+                    yield node_name(action), node_name(affect.action), affect.edge_kind
+            for email in action.start_emails + action.complete_emails:
+                yield email.vertex
+                yield node_name(action), email.node_name
 
 
 def find_roots(action_list, external_actions=None):
@@ -630,6 +1082,100 @@ def find_roots(action_list, external_actions=None):
     return roots
 
 
+def _trigger_node(graph, trigger):
+    affect = trigger.affect
+    if affect.type == "create_group":
+        return graph.group_nodes.get(affect.group_id)
+    return graph.action_nodes.get((affect.group_id, affect.action_id))
+
+
+def find_affected(ctx, actions=(), triggers=(), closure=None):
+    """Finds everything the actions and triggers eventually cause by following affects
+
+    Returns the actions affected, the groups created, and the emails the affected actions send, in the order of
+    ctx.affect_graph's nodes. closure is an analysis.Closure of ctx.affect_graph to use instead of walking it."""
+    graph = ctx.affect_graph
+    caused = {_trigger_node(graph, t) for t in triggers} - {None}
+    starts = [graph.action_nodes[(a.group_id, a.action_id)] for a in actions]
+    nodes = caused.union(reachable(graph, starts + list(caused), closure=closure))
+    affected = []
+    groups = []
+    for node in sorted(nodes):
+        if graph.is_group(node):
+            groups.append(ctx.groups[graph.key(node)])
+        else:
+            affected.append(ctx.actions[graph.key(node)])
+    emails = [e for a in affected for e in a.start_emails + a.complete_emails]
+    return affected, groups, emails
+
+
+def find_leading_to(ctx, action, action_list, closure=None):
+    """Finds the actions and the triggers in action_list's groups that eventually affect action
+
+    closure is a reverse analysis.Closure of ctx.affect_graph to use instead of walking it."""
+    graph = ctx.affect_graph
+    node = graph.action_nodes[(action.group_id, action.action_id)]
+    nodes = reachable(graph, [node], reverse=True, closure=closure)
+    actions = [ctx.actions[graph.key(n)] for n in nodes if not graph.is_group(n)]
+    leading = set(nodes)
+    leading.add(node)
+    triggers = [
+        t
+        for g in action_list.groups
+        for t in g.triggers
+        if _trigger_node(graph, t) in leading
+    ]
+    return actions, triggers
+
+
+def triggers_on(action_list, external_action_id):
+    """The triggers in action_list's groups that happen on the external action with external_action_id"""
+    return [
+        t
+        for g in action_list.groups
+        for t in g.triggers
+        if t.external_action.id == external_action_id
+    ]
+
+
+def _action_json(action):
+    return {
+        "group_id": action.group_id,
+        "action_id": action.action_id,
+        "path": action.path,
+    }
+
+
+def affected_json(ctx, actions=(), triggers=(), closure=None):
+    """find_affected as something json.dumps can take"""
+    affected, groups, emails = find_affected(ctx, actions, triggers, closure)
+    return {
+        "actions": [_action_json(a) for a in affected],
+        "groups": [{"id": g.id, "name": g.name} for g in groups],
+        "emails": [
+            {"name": e.name, "group_id": e.group_id, "action_id": e.action_id}
+            for e in emails
+        ],
+    }
+
+
+def leading_to_json(ctx, action, action_list, closure=None):
+    """find_leading_to as something json.dumps can take"""
+    actions, triggers = find_leading_to(ctx, action, action_list, closure)
+    return {
+        "actions": [_action_json(a) for a in actions],
+        "triggers": [
+            {"label": t.external_action.label, "affect": t.affect.desc}
+            for t in triggers
+        ],
+    }
+
+
+def cycles_json(ctx):
+    """find_cycles as something json.dumps can take"""
+    return [[_action_json(a) for a in loop] for loop in find_cycles(ctx)]
+
+
 def pprint_groups(alist):
     for group in alist.groups:
         print("Group:", group.name)
@@ -650,15 +1196,30 @@ def pprint_groups(alist):
 
 
 if __name__ == "__main__":
-    models = build_models()
+    args = sys.argv[1:]
+    if "--snapshot" in args:
+        # Run from a file written by snapshot.py rather than the db
+        from snapshot import load_snapshot
+
+        i = args.index("--snapshot")
+        models = load_snapshot(args[i + 1])
+        del args[i : i + 2]
+    else:
+        models = build_models(ACTION_LIST_DEF_ID if LOAD_ACTION_LIST_ONLY else None)
     ctx, alist = build_action_list(models, ACTION_LIST_DEF_ID)
-    action = sys.argv[1] if len(sys.argv) > 1 else "digraph"
+    action = args[0] if len(args) > 0 else "digraph"
     if action == "digraph":
-        print(generate_digraph_from_action_list(alist))
+        # digraph condensed draws loops of affects as one node each, and digraph reduced leaves out the affects that
+        # others imply. They can be combined
+        redundant = find_redundant_affects(ctx, alist) if "reduced" in args[1:] else ()
+        if "condensed" in args[1:]:
+            print(generate_condensed_digraph_from_action_list(ctx, alist, redundant))
+        else:
+            print(generate_digraph_from_action_list(alist, redundant))
     elif action == "group":
-        group_id = int(sys.argv[2])
+        group_id = int(args[1])
         group = ctx.groups[group_id]
-        print(generate_digraph_from_group(ctx.groups.values(), group))
+        print(generate_digraph_from_group(ctx, group))
     elif action == "partners":
         print(build_partners(models))
     elif action == "json":
@@ -667,10 +1228,29 @@ if __name__ == "__main__":
         print(json.dumps(asdict(alist), indent="  "))
     elif action == "pprint":
         pprint_groups(alist)
+    elif action == "reach":
+        # reach GROUP_ID ACTION_ID for what an action causes, with reverse after it for what leads to it, or
+        # reach trigger EXTERNAL_ACTION_ID for what the action list's triggers on that external action cause
+        import json
+
+        if args[1] == "trigger":
+            reached = affected_json(ctx, triggers=triggers_on(alist, int(args[2])))
+        else:
+            reached_action = ctx.actions[(int(args[1]), int(args[2]))]
+            if args[3:] == ["reverse"]:
+                reached = leading_to_json(ctx, reached_action, alist)
+            else:
+                reached = affected_json(ctx, [reached_action])
+        print(json.dumps(reached, indent="  "))
+    elif action == "cycles":
+        for loop in find_cycles(ctx):
+            print(f"Loop of {len(loop)} actions:")
+            for loop_action in loop:
+                print("  ", loop_action.path)
     elif action == "build":
         pass
     else:
         print(
-            f"Unknown action {action}. Valid options are digraph, build, partners, json, and pprint"
+            f"Unknown action {action}. Valid options are digraph, group, build, partners, json, pprint, reach, and cycles"
         )
         sys.exit(1)
@@ -0,0 +1,249 @@
+"""Runs Graphviz's dot for web with a cap on how many layouts run at once and how long each one can take"""
+import logging
+import subprocess
+import tempfile
+import threading
+import time
+
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RenderQueueFull(Exception):
+    """Raised instead of waiting when every dot process is busy and the queue for them is full"""
+
+    pass
+
+
+class RenderTimedOut(Exception):
+    """Raised when dot was killed for taking longer than the timeout"""
+
+    pass
+
+
+class RenderFailed(Exception):
+    """Raised when dot exits with an error"""
+
+    pass
+
+
+@lru_cache(maxsize=None)
+def graphviz_version():
+    # dot prints its version to stderr
+    run = subprocess.run(["dot", "-V"], stderr=subprocess.PIPE)
+    return run.stderr
+
+
+class RenderService:
+    """Runs at most workers dot processes at a time with up to max_queue renders waiting for one to be free
+
+    Every render is logged with how long it waited for a dot process and how long dot took."""
+
+    def __init__(self, workers, max_queue, timeout):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._waiting = 0
+
+    def _acquire(self):
+        if self._slots.acquire(blocking=False):
+            return
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                raise RenderQueueFull(
+                    f"All {self.workers} dot processes are busy and {self._waiting} renders are already waiting"
+                )
+            self._waiting += 1
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def render(self, digraph, format="svg"):
+        """Returns the output of dot for the digraph's bytes in the given format"""
+        queued_at = time.monotonic()
+        self._acquire()
+        started_at = time.monotonic()
+        try:
+            rendered = run_dot(digraph, format, self.timeout)
+        finally:
+            self._slots.release()
+        logger.info(
+            "Rendered %d bytes of dot after waiting %.3fs for a dot process in %.3fs",
+            len(digraph),
+            started_at - queued_at,
+            time.monotonic() - started_at,
+        )
+        return rendered
+
+    def stream(self, chunks, format="svg", rendered=None):
+        """Like render for a digraph given as an iterable of bytes, but writes each one to dot as it's produced and
+        yields dot's output as it's written
+
+        The dot process is only taken once this is first iterated, so RenderQueueFull and failures before dot writes
+        anything are raised by the first next. It's given back as soon as dot exits, however slowly this is iterated.
+        rendered is passed on to stream_dot."""
+        queued_at = time.monotonic()
+        self._acquire()
+        started_at = time.monotonic()
+        rendered_in = []
+
+        def exited():
+            rendered_in.append(time.monotonic() - started_at)
+            self._slots.release()
+
+        size = 0
+        for chunk in stream_dot(
+            chunks, format, self.timeout, exited=exited, rendered=rendered
+        ):
+            size += len(chunk)
+            yield chunk
+        logger.info(
+            "Streamed %d bytes from dot after waiting %.3fs for a dot process in %.3fs",
+            size,
+            started_at - queued_at,
+            rendered_in[0],
+        )
+
+
+def run_dot(digraph, format="svg", timeout=None):
+    """Returns the output of dot for the digraph's bytes, raising RenderTimedOut or RenderFailed if it doesn't succeed"""
+    try:
+        run = subprocess.run(
+            ["dot", f"-T{format}"],
+            input=digraph,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        # run has already killed dot
+        raise RenderTimedOut(
+            f"dot took longer than {timeout}s on {len(digraph)} bytes"
+        ) from None
+    if run.returncode != 0:
+        raise RenderFailed(
+            f"dot exited with {run.returncode}: {run.stderr.decode('utf-8', 'replace')}"
+        )
+    return run.stdout
+
+
+def stream_dot(
+    chunks, format="svg", timeout=None, read_size=64 * 1024, exited=None, rendered=None
+):
+    """Yields the output of dot as it's written while a thread writes the digraph to it from an iterable of bytes
+
+    Another thread reads dot's output into memory as fast as dot writes it, so how fast this is iterated doesn't hold
+    dot up or count towards timeout. exited is called from it once dot has exited, or from here if dot couldn't be
+    started. rendered is then called from it with all of dot's output if dot succeeded, before this has necessarily
+    yielded all of it, and anything it raises is raised from here. Raises RenderTimedOut or RenderFailed like run_dot
+    once dot's output ends, or anything raised by chunks. dot is killed if this is closed before it's done."""
+    stderr = tempfile.TemporaryFile()
+    try:
+        # stderr goes to a file so dot never blocks on a full pipe no one's reading
+        dot = subprocess.Popen(
+            ["dot", f"-T{format}"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+    except BaseException:
+        stderr.close()
+        if exited is not None:
+            exited()
+        raise
+    errors = []
+    timed_out = threading.Event()
+    # dot's output that hasn't been yielded yet, and whether dot is done, under changed
+    output = []
+    # All of dot's output for rendered, only touched by the reader
+    everything = []
+    finished = []
+    changed = threading.Condition()
+
+    def write():
+        try:
+            for chunk in chunks:
+                dot.stdin.write(chunk)
+            dot.stdin.close()
+        except BrokenPipeError:
+            # dot exited early, which is reported from its return code
+            pass
+        except Exception as e:
+            errors.append(e)
+            dot.kill()
+
+    def kill():
+        timed_out.set()
+        dot.kill()
+
+    def read():
+        try:
+            while True:
+                chunk = dot.stdout.read1(read_size)
+                if not chunk:
+                    break
+                everything.append(chunk)
+                with changed:
+                    output.append(chunk)
+                    changed.notify()
+            dot.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if dot.poll() is None:
+                dot.kill()
+                dot.wait()
+            writer.join()
+            dot.stdout.close()
+            if exited is not None:
+                exited()
+            try:
+                succeeded = not errors and not timed_out.is_set()
+                if rendered is not None and succeeded and dot.returncode == 0:
+                    rendered(b"".join(everything))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with changed:
+                    finished.append(True)
+                    changed.notify()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            with changed:
+                while not output and not finished:
+                    changed.wait()
+                ready = output[:]
+                output.clear()
+                done = bool(finished)
+            yield from ready
+            if done and not ready:
+                break
+    finally:
+        if not finished:
+            dot.kill()
+        reader.join()
+        stderr.seek(0)
+        dot_errors = stderr.read()
+        stderr.close()
+    if errors:
+        raise errors[0]
+    if timed_out.is_set():
+        raise RenderTimedOut(f"dot took longer than {timeout}s")
+    if dot.returncode != 0:
+        raise RenderFailed(
+            f"dot exited with {dot.returncode}: {dot_errors.decode('utf-8', 'replace')}"
+        )
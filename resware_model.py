@@ -1,13 +1,26 @@
 """Raw in-memory representations of the data in ResWare's db relating to action list definitions and friends
 
-We make it easy to load all of that at once to make it easier to create an object graph without having to do
-complicated queries to only fetch the bits we once. Since the action lists will never be 1000s and 1000s of steps,
-loading all of this shouldn't be prohibitive."""
+Models.from_db loads all of it at once, which makes it easy to create an object graph of any action list. Since the
+action lists will never be 1000s and 1000s of steps, that shouldn't be prohibitive. Models.for_action_list loads only
+the rows one action list can reach for when it's the only one needed, and Models.refresh brings already loaded models
+up to date with just the rows that changed."""
+import collections
 import enum
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
-from database import col, tableclass, ResWareDatabaseConnection, load
+from database import (
+    col,
+    tableclass,
+    ConnectionPool,
+    NOT_NULL,
+    ResWareDatabaseConnection,
+    load,
+    load_many,
+    sync_token,
+)
+from settings import RESWARE_DATABASE_CONCURRENCY
 
 
 class Task(enum.IntEnum):
@@ -101,13 +114,23 @@ class Email:
     # There are also a huge number of columns controlling what's generated. Add em as needed
 
 
-@tableclass("ActionEmailTemplateDocumentTypeRef", lookup="email_id", one_to_many=True)
+@tableclass(
+    "ActionEmailTemplateDocumentTypeRef",
+    lookup="email_id",
+    one_to_many=True,
+    primary_key=("email_id", "document_type_id"),
+)
 class EmailDocument:
     email_id: int = col("ActionEmailTemplateID")
     document_type_id: int = col("DocumentTypeID")
 
 
-@tableclass("ActionEmailTemplatePartnerTypeRef", lookup="email_id", one_to_many=True)
+@tableclass(
+    "ActionEmailTemplatePartnerTypeRef",
+    lookup="email_id",
+    one_to_many=True,
+    primary_key=("email_id", "partner_type_id"),
+)
 class EmailPartnerTypeRecipient:
     """The partner type that should receive the email"""
 
@@ -115,14 +138,26 @@ class EmailPartnerTypeRecipient:
     partner_type_id: int = col("PartnerTypeID")
 
 
-@tableclass("PartnerCompanyActionEmailTemplateRel", one_to_many=True, lookup="email_id")
+# There's at least one restriction row for every email template. The partner is NULL if it's a
+# placeholder and there aren't any real ones, so skip those
+@tableclass(
+    "PartnerCompanyActionEmailTemplateRel",
+    one_to_many=True,
+    lookup="email_id",
+    where={"PartnerCompanyID": NOT_NULL},
+)
 class EmailPartnerRestriction:
-    partner_id: int = col("PartnerCompanyID", nullable=True)
+    partner_id: int = col("PartnerCompanyID")
     email_id: int = col("ActionEmailTemplateID")
     include: bool = col("IncludeExclude")
 
 
-@tableclass("ActionEmailTemplateTemplateRef", lookup="email_id", one_to_many=True)
+@tableclass(
+    "ActionEmailTemplateTemplateRef",
+    lookup="email_id",
+    one_to_many=True,
+    primary_key=("email_id", "template_id"),
+)
 class EmailTemplate:
     email_id: int = col("ActionEmailTemplateID")
     template_id: int = col("TemplateID")
@@ -141,11 +176,19 @@ def _email_start_complete_to_task(start_complete):
     return Task.COMPLETE if start_complete else Task.START
 
 
+def _task_to_email_start_complete(task):
+    return task == Task.COMPLETE
+
+
 @tableclass("ActionDefActionEmailTemplateRel", lookup="action_id", one_to_many=True)
 class ActionEmail:
     action_id: int = col("ActionDefID")
     email_id: int = col("ActionEmailTemplateID")
-    task: Task = col("ActionStartComplete", parser=_email_start_complete_to_task)
+    task: Task = col(
+        "ActionStartComplete",
+        parser=_email_start_complete_to_task,
+        serializer=_task_to_email_start_complete,
+    )
 
 
 @tableclass(
@@ -175,30 +218,53 @@ def _group_partner_include(type_id):
     return type_id == 1
 
 
+def _group_partner_include_to_type_id(include):
+    return 1 if include else 2
+
+
 @tableclass(
     "ActionListGroupActionDefPartnerRel",
     one_to_many=True,
     lookup=("group_id", "action_id"),
+    primary_key=("group_id", "action_id", "partner_id"),
 )
 class GroupActionPartnerRestriction:
     group_id: int = col("ActionListGroupDefID")
     action_id: int = col("ActionDefID")
     partner_id: int = col("PartnerCompanyID")
-    include: bool = col("ActionPartnerAddTypeID", parser=_group_partner_include)
+    include: bool = col(
+        "ActionPartnerAddTypeID",
+        parser=_group_partner_include,
+        serializer=_group_partner_include_to_type_id,
+    )
 
 
-@tableclass("ActionListGroupActionDef", lookup="group_id", one_to_many=True)
+@tableclass(
+    "ActionListGroupActionDef",
+    lookup="group_id",
+    one_to_many=True,
+    primary_key=("group_id", "action_id"),
+)
 class GroupAction:
     group_id: int = col("ActionListGroupDefID")
     action_id: int = col("ActionDefID")
     dynamic: bool = col("Dynamic")
 
 
-@tableclass("ActionListGroupDefPartnerRel", one_to_many=True, lookup="group_id")
+@tableclass(
+    "ActionListGroupDefPartnerRel",
+    one_to_many=True,
+    lookup="group_id",
+    primary_key=("group_id", "partner_id"),
+)
 class GroupPartnerRestriction:
     group_id: int = col("ActionListGroupDefID")
     partner_id: int = col("PartnerCompanyID")
-    include: bool = col("ActionPartnerAddTypeID", parser=_group_partner_include)
+    include: bool = col(
+        "ActionPartnerAddTypeID",
+        parser=_group_partner_include,
+        serializer=_group_partner_include_to_type_id,
+    )
 
 
 @tableclass("ActionListGroupDef")
@@ -235,7 +301,9 @@ class Partner:
     name: str = col("Name")
 
 
-@tableclass("PartnerCompanyPartnerTypeRel", one_to_many=True)
+@tableclass(
+    "PartnerCompanyPartnerTypeRel", one_to_many=True, primary_key=("id", "type_id")
+)
 class PartnerTypes:
     id: int = col("PartnerCompanyID")
     type_id: int = col("PartnerTypeID")
@@ -255,49 +323,232 @@ class PartnerType:
     name: str = col("Name")
 
 
+# The attribute on Models for each tableclass loaded into it
+TABLES = {
+    "partners": Partner,
+    "partners_types": PartnerTypes,
+    "partners_auto_adds": PartnerAutoAdds,
+    "partner_types": PartnerType,
+    "triggers": Trigger,
+    "external_actions": ExternalAction,
+    "emails": Email,
+    "email_documents": EmailDocument,
+    "email_partner_type_recipients": EmailPartnerTypeRecipient,
+    "email_partner_restrictions": EmailPartnerRestriction,
+    "email_templates": EmailTemplate,
+    "templates": Template,
+    "action_emails": ActionEmail,
+    "action_events": ActionEvent,
+    "document_types": DocumentType,
+    "actions": Action,
+    "group_actions": GroupAction,
+    "group_action_partner_restrictions": GroupActionPartnerRestriction,
+    "groups": Group,
+    "group_partner_restrictions": GroupPartnerRestriction,
+    "group_action_affects": GroupActionAffect,
+    "action_lists": ActionList,
+    "action_list_groups": ActionListGroups,
+}
+
+
+def _affected_group_ids(affect):
+    return {
+        affect.affected_group_id,
+        affect.created_action_group_id,
+        affect.created_group_id,
+    } - {None}
+
+
+def _merge(results, more):
+    for key, instances in more.items():
+        results[key].extend(instances)
+
+
+def _load_reachable_groups(conn, action_list_id):
+    """Loads the groups in the action list and the affects and triggers of them and every group they can affect
+
+    Returns the ids of all the groups, the ActionListGroups for the action list, and the GroupActionAffects and
+    Triggers of all the groups. Each pass over the affects of newly reached groups is a round trip."""
+    action_list_groups = load(
+        conn, ActionListGroups, where={"ActionListDefId": action_list_id}
+    )
+    affects = collections.defaultdict(list)
+    triggers = collections.defaultdict(list)
+    group_ids = set()
+    reached = {g.group_id for g in action_list_groups[action_list_id]}
+    while reached:
+        group_ids |= reached
+        wheres = {
+            GroupActionAffect: {"ActionListGroupDefID": reached},
+            Trigger: {"ActionListGroupDefID": reached},
+        }
+        loaded = load_many(conn, [GroupActionAffect, Trigger], wheres=wheres)
+        _merge(affects, loaded[GroupActionAffect])
+        _merge(triggers, loaded[Trigger])
+        reached = set()
+        for affect_list in [
+            *loaded[GroupActionAffect].values(),
+            *loaded[Trigger].values(),
+        ]:
+            for affect in affect_list:
+                reached |= _affected_group_ids(affect)
+        reached -= group_ids
+    return group_ids, action_list_groups, affects, triggers
+
+
+def _values(results, attr):
+    """Returns the set of attr on all the instances in results from load"""
+    values = set()
+    for instances in results.values():
+        if not isinstance(instances, list):
+            instances = [instances]
+        values.update((getattr(i, attr) for i in instances))
+    return values
+
+
 class Models:
-    def __init__(self, conn):
-        self.partners = load(conn, Partner)
-        self.partners_types = load(conn, PartnerTypes)
-        self.partners_auto_adds = load(conn, PartnerAutoAdds)
-        self.partner_types = load(conn, PartnerType)
-        self.triggers = load(conn, Trigger)
-        self.external_actions = load(conn, ExternalAction)
-        self.emails = load(conn, Email)
-        self.email_documents = load(conn, EmailDocument)
-        self.email_partner_type_recipients = load(conn, EmailPartnerTypeRecipient)
-
-        # There's at least one restriction column for every email template The partner is NULL if
-        # it's a placeholder and there aren't any real ones
-        self.email_partner_restrictions = load(conn, EmailPartnerRestriction)
-        for email_id, partners in list(self.email_partner_restrictions.items()):
-            for partner in partners[:]:
-                if partner.partner_id is None:
-                    partners.remove(partner)
-            # If the list is now empty, delete it from the dict
-            if len(partners) == 0:
-                del self.email_partner_restrictions[email_id]
-
-        self.email_templates = load(conn, EmailTemplate)
-        self.templates = load(conn, Template)
-        self.action_emails = load(conn, ActionEmail)
-        self.action_events = load(conn, ActionEvent)
-        self.document_types = load(conn, DocumentType)
-        self.actions = load(conn, Action)
-        self.group_actions = load(conn, GroupAction)
-        self.group_action_partner_restrictions = load(
-            conn, GroupActionPartnerRestriction
+    """The contents of every table in TABLES as returned by load, each on its attribute from TABLES
+
+    If action_list_id is set, the tables only contain the rows needed to build that action list.
+
+    Once created, a Models isn't modified. refresh returns a new one instead."""
+
+    def __init__(self, tables, sync_token=None, action_list_id=None):
+        for name in TABLES:
+            setattr(self, name, tables[name])
+        # The change tracking version the tables were loaded at or None if the db doesn't track changes
+        self.sync_token = sync_token
+        self.action_list_id = action_list_id
+
+    @classmethod
+    def from_db(cls, conn):
+        # Read the version first so anything that changes while we're loading is picked up by the next refresh
+        token = sync_token(conn)
+        loaded = load_many(conn, list(TABLES.values()))
+        return cls(
+            {name: loaded[tablecls] for name, tablecls in TABLES.items()},
+            token,
+        )
+
+    @classmethod
+    def from_pool(cls, pool):
+        """Loads the tables in parallel with a thread for every connection in the pool"""
+
+        def load_table(name):
+            with pool.connection() as conn:
+                return load(conn, TABLES[name])
+
+        with pool.connection() as conn:
+            token = sync_token(conn)
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = {name: executor.submit(load_table, name) for name in TABLES}
+            return cls({name: f.result() for name, f in futures.items()}, token)
+
+    @classmethod
+    def for_action_list(cls, conn, action_list_id):
+        """Loads only the rows needed to build the given action list
+
+        That's the groups in the action list, the groups they can reach through affects and triggers, and their
+        actions, emails, templates, partners, and document types. Each of those is filtered in the db by the ids found
+        in the tables loaded before it."""
+        tables = {}
+        (
+            group_ids,
+            tables["action_list_groups"],
+            tables["group_action_affects"],
+            tables["triggers"],
+        ) = _load_reachable_groups(conn, action_list_id)
+
+        def load_batch(wheres):
+            loaded = load_many(conn, list(wheres), wheres=wheres)
+            for name, tablecls in TABLES.items():
+                if tablecls in loaded:
+                    tables[name] = loaded[tablecls]
+
+        load_batch(
+            {
+                Group: {"ActionListGroupDefID": group_ids},
+                GroupAction: {"ActionListGroupDefID": group_ids},
+                GroupActionPartnerRestriction: {"ActionListGroupDefID": group_ids},
+                GroupPartnerRestriction: {"ActionListGroupDefID": group_ids},
+                ActionList: {"ActionListDefID": action_list_id},
+                PartnerType: None,
+                ExternalAction: None,
+                ActionEvent: None,
+            }
         )
-        self.groups = load(conn, Group)
-        self.group_partner_restrictions = load(conn, GroupPartnerRestriction)
-        self.group_action_affects = load(conn, GroupActionAffect)
-        self.action_lists = load(conn, ActionList)
-        self.action_list_groups = load(conn, ActionListGroups)
+        action_ids = _values(tables["group_actions"], "action_id")
+        load_batch(
+            {
+                Action: {"ActionDefID": action_ids},
+                ActionEmail: {"ActionDefID": action_ids},
+            }
+        )
+        email_ids = _values(tables["action_emails"], "email_id")
+        load_batch(
+            {
+                Email: {"ActionEmailTemplateID": email_ids},
+                EmailDocument: {"ActionEmailTemplateID": email_ids},
+                EmailPartnerTypeRecipient: {"ActionEmailTemplateID": email_ids},
+                EmailPartnerRestriction: {"ActionEmailTemplateID": email_ids},
+                EmailTemplate: {"ActionEmailTemplateID": email_ids},
+            }
+        )
+        partner_ids = set()
+        for table in [
+            "group_action_partner_restrictions",
+            "group_partner_restrictions",
+            "email_partner_restrictions",
+        ]:
+            partner_ids |= _values(tables[table], "partner_id")
+        load_batch(
+            {
+                Template: {
+                    "TemplateID": _values(tables["email_templates"], "template_id")
+                },
+                Partner: {"PartnerCompanyID": partner_ids},
+                PartnerTypes: {"PartnerCompanyID": partner_ids},
+                PartnerAutoAdds: {"PartnerCompanyID": partner_ids},
+            }
+        )
+        document_type_ids = (
+            _values(tables["triggers"], "document_type_id")
+            | _values(tables["email_documents"], "document_type_id")
+            | _values(tables["templates"], "document_type_id")
+        ) - {None}
+        load_batch({DocumentType: {"DocumentTypeID": document_type_ids}})
+        return cls(tables, action_list_id=action_list_id)
+
+    def refresh(self, conn):
+        """Returns a new Models with the current contents of the db, only fetching the rows changed since this one was
+        loaded from tables that support that"""
+        if self.action_list_id is not None:
+            return Models.for_action_list(conn, self.action_list_id)
+        token = sync_token(conn)
+        if token is None or self.sync_token is None:
+            return Models.from_db(conn)
+        tables = {
+            name: load(conn, tablecls, self.sync_token, getattr(self, name))
+            for name, tablecls in TABLES.items()
+        }
+        return Models(tables, token)
+
+
+def build_models(action_list_id=None):
+    """Loads everything from the db or only what's needed for action_list_id if it's given"""
+    if action_list_id is not None:
+        with ResWareDatabaseConnection() as conn:
+            return Models.for_action_list(conn, action_list_id)
+    if RESWARE_DATABASE_CONCURRENCY > 1:
+        with ConnectionPool(RESWARE_DATABASE_CONCURRENCY) as pool:
+            return Models.from_pool(pool)
+    with ResWareDatabaseConnection() as conn:
+        return Models.from_db(conn)
 
 
-def build_models():
+def refresh_models(models):
     with ResWareDatabaseConnection() as conn:
-        return Models(conn)
+        return models.refresh(conn)
 
 
 if __name__ == "__main__":
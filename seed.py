@@ -0,0 +1,32 @@
+"""Copies a snapshot from snapshot.py into a SQLite file that can stand in for ResWare's db
+
+Run python seed.py SNAPSHOT SQLITE_PATH, then set RESWARE_DATABASE_BACKEND=sqlite and RESWARE_SQLITE_PATH=SQLITE_PATH to
+load from it like it's the real db."""
+import os
+import sys
+
+from database import ResWareDatabaseConnection, SQLiteBackend, create_tables, insert
+from resware_model import TABLES
+from snapshot import load_snapshot
+
+
+def seed(models, path):
+    """Writes the tables in models to a new SQLite db at path"""
+    if os.path.exists(path):
+        raise Exception(f"{path} already exists. Remove it first to seed a new db")
+    with ResWareDatabaseConnection(SQLiteBackend(path)) as conn:
+        create_tables(conn, TABLES.values())
+        for name, tablecls in TABLES.items():
+            results = getattr(models, name)
+            if tablecls.one_to_many:
+                instances = [i for instances in results.values() for i in instances]
+            else:
+                instances = list(results.values())
+            insert(conn, tablecls, instances)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python seed.py SNAPSHOT SQLITE_PATH")
+        sys.exit(1)
+    seed(load_snapshot(sys.argv[1]), sys.argv[2])
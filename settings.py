@@ -23,8 +23,42 @@ RESWARE_DATABASE_PORT = os.getenv("RESWARE_DATABASE_PORT")
 RESWARE_DATABASE_USER = os.getenv("RESWARE_DATABASE_USER")
 RESWARE_DATABASE_PASSWORD = os.getenv("RESWARE_DATABASE_PASSWORD")
 RESWARE_DATABASE_NAME = os.getenv("RESWARE_DATABASE_NAME")
+# mssql to use the SQL Server settings above or sqlite to use the SQLite file at RESWARE_SQLITE_PATH
+RESWARE_DATABASE_BACKEND = os.getenv("RESWARE_DATABASE_BACKEND", "mssql")
+RESWARE_SQLITE_PATH = os.getenv("RESWARE_SQLITE_PATH", "resware.sqlite")
+# How many connections to load ResWare's tables over in parallel
+RESWARE_DATABASE_CONCURRENCY = int(os.getenv("RESWARE_DATABASE_CONCURRENCY", 1))
 
 # Action List To Graph
 ACTION_LIST_DEF_ID = int(os.getenv("ACTION_LIST_DEF_ID", 0))
+# Only load the parts of the db ACTION_LIST_DEF_ID needs rather than every action list definition
+LOAD_ACTION_LIST_ONLY = os.getenv("LOAD_ACTION_LIST_ONLY", "").lower() in ("1", "true")
+
+# Only build the groups in ACTION_LIST_DEF_ID up front in web and the rest the first time a page needs them
+LAZY_GRAPH = os.getenv("LAZY_GRAPH", "").lower() in ("1", "true")
+
+# Precompute which actions reach which in web so the reach endpoints are lookups. Takes memory quadratic in the number
+# of actions in the worst case
+REACH_CLOSURE = os.getenv("REACH_CLOSURE", "").lower() in ("1", "true")
+
+# Path to a file written by snapshot.py for web to load its models from instead of the db
+MODELS_SNAPSHOT = os.getenv("MODELS_SNAPSHOT")
+
+# Seconds web serves the models and graph it built before rebuilding them in the background
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", 300))
+
+# Bytes of rendered SVGs each web process keeps in memory
+SVG_CACHE_BYTES = int(os.getenv("SVG_CACHE_BYTES", 64 * 1024 * 1024))
+# Directory to also keep rendered SVGs in so every web process on the box can use them. Unset to only use memory
+SVG_CACHE_DIR = os.getenv("SVG_CACHE_DIR")
+
+# How many dot processes each web process runs at once, how many renders can wait for one before
+# getting a 503, and the seconds a render can take before dot is killed
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_QUEUE_DEPTH = int(os.getenv("RENDER_QUEUE_DEPTH", 8))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 60))
+
+# Render every group in the background whenever web builds its graph so pages are served from the cache
+PRERENDER = os.getenv("PRERENDER", "").lower() in ("1", "true")
 
 WEB_TOKEN = os.getenv("WEB_TOKEN")
@@ -0,0 +1,98 @@
+"""Saves a loaded Models to a local file and loads it back without touching the db
+
+A snapshot starts with a header line naming the format version and a hash of the tableclasses in resware_model.TABLES
+it was written with. The rest is the zlib compressed pickle of the field values of every instance in each table. Storing
+tuples of values rather than the instances themselves keeps the file compact and quick to load. Loading a snapshot
+written with a different format version or different tableclasses raises SnapshotMismatch rather than producing Models
+with the wrong shape."""
+import hashlib
+import pickle
+import sys
+import zlib
+
+from dataclasses import fields
+
+from database import index
+from resware_model import TABLES, Models, build_models
+from settings import ACTION_LIST_DEF_ID, LOAD_ACTION_LIST_ONLY
+
+MAGIC = b"flow-snapshot"
+VERSION = 1
+# Protocol 4 is the newest one every Python we run on can read
+PICKLE_PROTOCOL = 4
+
+
+class SnapshotMismatch(Exception):
+    """Raised when a snapshot wasn't written with the current format version and tableclasses"""
+
+    pass
+
+
+def schema_hash():
+    """Hashes everything about the tableclasses in TABLES that the stored field values depend on"""
+    schema = [
+        (
+            name,
+            tablecls.table,
+            tablecls.columns,
+            [(f.name, repr(f.type)) for f in fields(tablecls)],
+            tablecls.lookup,
+            tablecls.one_to_many,
+            repr(sorted(tablecls.where.items())),
+        )
+        for name, tablecls in TABLES.items()
+    ]
+    return hashlib.sha256(repr(schema).encode("utf-8")).hexdigest()[:16]
+
+
+def _header():
+    return b" ".join([MAGIC, str(VERSION).encode(), schema_hash().encode()]) + b"\n"
+
+
+def _instances(tablecls, results):
+    if tablecls.one_to_many:
+        return [i for instances in results.values() for i in instances]
+    return list(results.values())
+
+
+def save_snapshot(models, path):
+    names = {name: [f.name for f in fields(t)] for name, t in TABLES.items()}
+    tables = {
+        name: [
+            tuple([getattr(i, n) for n in names[name]])
+            for i in _instances(tablecls, getattr(models, name))
+        ]
+        for name, tablecls in TABLES.items()
+    }
+    payload = {
+        "sync_token": models.sync_token,
+        "action_list_id": models.action_list_id,
+        "tables": tables,
+    }
+    with open(path, "wb") as f:
+        f.write(_header())
+        f.write(zlib.compress(pickle.dumps(payload, protocol=PICKLE_PROTOCOL)))
+
+
+def load_snapshot(path):
+    with open(path, "rb") as f:
+        header = f.readline()
+        if header != _header():
+            raise SnapshotMismatch(
+                f"{path} starts with {header!r}, but the current snapshot header is {_header()!r}"
+            )
+        payload = pickle.loads(zlib.decompress(f.read()))
+    tables = {
+        name: index(tablecls, [tablecls(*values) for values in payload["tables"][name]])
+        for name, tablecls in TABLES.items()
+    }
+    return Models(tables, payload["sync_token"], payload["action_list_id"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python snapshot.py PATH to save the models in the db to PATH")
+        sys.exit(1)
+    save_snapshot(
+        build_models(ACTION_LIST_DEF_ID if LOAD_ACTION_LIST_ONLY else None), sys.argv[1]
+    )
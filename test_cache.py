@@ -0,0 +1,96 @@
+"""Tests for coalescing concurrent work with SingleFlight
+
+Run with python -m unittest from the root of the repo."""
+import threading
+import unittest
+
+from cache import SingleFlight
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.runs = 0
+        # Set by the test to let produce carry on past its first chunk
+        self.proceed = threading.Event()
+
+    def produce(self, land, land_early=True):
+        self.runs += 1
+        yield b"a"
+        if land_early:
+            land(b"ab")
+        self.proceed.wait(5)
+        yield b"b"
+        if not land_early:
+            land(b"ab")
+
+    def follow(self, produce):
+        # Joins the flight from another thread, returning a function to get its chunks or raise its exception
+        result = {}
+
+        def run():
+            try:
+                result["chunks"] = list(self.flights.stream("key", produce))
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        def chunks():
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            if "error" in result:
+                raise result["error"]
+            return result["chunks"]
+
+        return chunks
+
+    def test_followers_dont_wait_for_the_leader_to_finish_iterating(self):
+        leader = self.flights.stream("key", self.produce)
+        self.assertEqual(next(leader), b"a")
+        # Landed on the way to b, which is held up until proceed is set
+        flight = self.flights._flights.get("key")
+        self.assertIsNotNone(flight)
+        landing = threading.Thread(target=next, args=(leader,))
+        landing.start()
+        self.assertTrue(flight.done.wait(5))
+        self.assertEqual(flight.result, b"ab")
+        self.proceed.set()
+        landing.join(5)
+
+    def test_followers_start_over_if_the_leader_stops_before_landing(self):
+        def produce(land):
+            return self.produce(land, land_early=False)
+
+        leader = self.flights.stream("key", produce)
+        self.assertEqual(next(leader), b"a")
+        flight = self.flights._flights["key"]
+        follower = self.follow(produce)
+        leader.close()
+        self.assertTrue(flight.done.wait(5))
+        self.assertIsNone(flight.result)
+        self.proceed.set()
+        self.assertEqual(follower(), [b"a", b"b"])
+        self.assertEqual(self.runs, 2)
+
+    def test_followers_get_the_leaders_error(self):
+        def produce(land):
+            yield b"a"
+            self.proceed.wait(5)
+            raise ValueError("boom")
+
+        leader = self.flights.stream("key", produce)
+        self.assertEqual(next(leader), b"a")
+        flight = self.flights._flights["key"]
+        follower = self.follow(produce)
+        self.proceed.set()
+        with self.assertRaises(ValueError):
+            next(leader)
+        self.assertIsInstance(flight.error, ValueError)
+        with self.assertRaises(ValueError):
+            follower()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+"""Tests for patching change tracking rows from ResWare's db into previously loaded tables
+
+Run with python -m unittest from the root of the repo."""
+import contextlib
+import unittest
+
+from database import _load_changes, _load_incrementally, _patch
+from resware_model import Action, GroupAction, GroupActionAffect, PartnerTypes
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def execute(self, query, params=()):
+        self.conn.queries.append((query, params))
+        for start, result in self.conn.results.items():
+            if query.startswith(start):
+                self.result = result
+                return
+        raise AssertionError(f"Unexpected query {query}")
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Answers the change tracking queries that only SQL Server supports with results by how the query starts"""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def cursor(self):
+        return contextlib.closing(FakeCursor(self))
+
+
+def _min_valid(version):
+    return {"SELECT CHANGE_TRACKING_MIN_VALID_VERSION": [(version,)]}
+
+
+class PatchOneToOneTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = {
+            1: Action(1, "First", "First", None, False),
+            2: Action(2, "Second", "Second", None, False),
+        }
+
+    def test_insert_update_and_delete(self):
+        changes = [
+            ("U", 1, "Renamed", "Renamed", "Now described", True),
+            ("D", 2, None, None, None, None),
+            ("I", 3, "Third", "Third", None, False),
+        ]
+        patched = _patch(Action, self.previous, changes)
+        self.assertEqual(
+            patched,
+            {
+                1: Action(1, "Renamed", "Renamed", "Now described", True),
+                3: Action(3, "Third", "Third", None, False),
+            },
+        )
+
+    def test_leaves_previous_untouched(self):
+        expected = dict(self.previous)
+        _patch(Action, self.previous, [("D", 1, None, None, None, None)])
+        self.assertEqual(self.previous, expected)
+
+    def test_deleting_a_row_that_was_never_loaded(self):
+        patched = _patch(Action, self.previous, [("D", 5, None, None, None, None)])
+        self.assertEqual(patched, self.previous)
+
+
+class PatchOneToManyTest(unittest.TestCase):
+    def setUp(self):
+        self.first = [GroupAction(1, 10, False), GroupAction(1, 11, False)]
+        self.second = [GroupAction(2, 20, False)]
+        self.previous = {1: self.first, 2: self.second}
+
+    def test_replaces_by_primary_key_within_the_list(self):
+        patched = _patch(GroupAction, self.previous, [("U", 1, 11, True)])
+        self.assertEqual(
+            patched[1], [GroupAction(1, 10, False), GroupAction(1, 11, True)]
+        )
+        self.assertEqual(patched[2], self.second)
+
+    def test_insert_into_new_and_existing_lists(self):
+        patched = _patch(
+            GroupAction, self.previous, [("I", 1, 12, False), ("I", 3, 30, True)]
+        )
+        self.assertEqual(
+            patched[1],
+            [
+                GroupAction(1, 10, False),
+                GroupAction(1, 11, False),
+                GroupAction(1, 12, False),
+            ],
+        )
+        self.assertEqual(patched[3], [GroupAction(3, 30, True)])
+
+    def test_deleting_the_last_instance_removes_the_key(self):
+        patched = _patch(
+            GroupAction, self.previous, [("D", 2, 20, None), ("D", 1, 10, None)]
+        )
+        self.assertEqual(patched, {1: [GroupAction(1, 11, False)]})
+
+    def test_several_changes_to_one_list(self):
+        patched = _patch(
+            GroupAction,
+            self.previous,
+            [("D", 1, 10, None), ("U", 1, 11, True), ("I", 1, 12, False)],
+        )
+        self.assertEqual(
+            patched[1], [GroupAction(1, 11, True), GroupAction(1, 12, False)]
+        )
+
+    def test_leaves_previous_untouched(self):
+        _patch(
+            GroupAction,
+            self.previous,
+            [("D", 1, 10, None), ("U", 2, 20, True), ("I", 1, 12, False)],
+        )
+        self.assertEqual(
+            self.previous,
+            {
+                1: [GroupAction(1, 10, False), GroupAction(1, 11, False)],
+                2: [GroupAction(2, 20, False)],
+            },
+        )
+        self.assertIs(self.previous[1], self.first)
+
+    def test_primary_key_beyond_the_lookup(self):
+        # PartnerTypes is looked up by partner id but a row is a (partner id, type id) pair
+        previous = {7: [PartnerTypes(7, 1), PartnerTypes(7, 2)]}
+        patched = _patch(PartnerTypes, previous, [("D", 7, 1), ("I", 7, 3)])
+        self.assertEqual(patched, {7: [PartnerTypes(7, 2), PartnerTypes(7, 3)]})
+
+
+class LoadChangesTest(unittest.TestCase):
+    def test_takes_primary_key_from_the_change_table(self):
+        rows = [("D", 1, 10, None)]
+        conn = FakeConnection({"SELECT CASE": rows})
+        self.assertEqual(_load_changes(conn, GroupAction, 7), rows)
+        [(query, params)] = conn.queries
+        self.assertEqual(params, (7,))
+        self.assertIn(
+            "ct.ActionListGroupDefID, ct.ActionDefID, t.Dynamic FROM "
+            "CHANGETABLE(CHANGES ActionListGroupActionDef, %s) AS ct",
+            query,
+        )
+        self.assertIn(
+            "LEFT JOIN ActionListGroupActionDef AS t ON "
+            "t.ActionListGroupDefID = ct.ActionListGroupDefID AND t.ActionDefID = ct.ActionDefID",
+            query,
+        )
+        self.assertIn("WHEN t.ActionListGroupDefID IS NULL THEN 'D'", query)
+
+
+class LoadIncrementallyTest(unittest.TestCase):
+    previous = {1: [GroupAction(1, 10, False)]}
+
+    def test_patches_changes_since_the_version(self):
+        conn = FakeConnection({**_min_valid(5), "SELECT CASE": [("I", 1, 11, True)]})
+        self.assertEqual(
+            _load_incrementally(conn, GroupAction, 7, self.previous),
+            {1: [GroupAction(1, 10, False), GroupAction(1, 11, True)]},
+        )
+
+    def test_reloads_without_change_tracking(self):
+        conn = FakeConnection(_min_valid(None))
+        self.assertIsNone(_load_incrementally(conn, GroupAction, 7, self.previous))
+
+    def test_reloads_when_the_changes_were_cleaned_up(self):
+        conn = FakeConnection(_min_valid(9))
+        self.assertIsNone(_load_incrementally(conn, GroupAction, 7, self.previous))
+
+    def test_keeps_unchanged_tables_without_a_primary_key(self):
+        previous = {}
+        conn = FakeConnection({**_min_valid(5), "SELECT COUNT(*)": [(0,)]})
+        self.assertIs(
+            _load_incrementally(conn, GroupActionAffect, 7, previous), previous
+        )
+
+    def test_reloads_changed_tables_without_a_primary_key(self):
+        conn = FakeConnection({**_min_valid(5), "SELECT COUNT(*)": [(2,)]})
+        self.assertIsNone(_load_incrementally(conn, GroupActionAffect, 7, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
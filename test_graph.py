@@ -0,0 +1,43 @@
+"""Tests for building the action list's graph
+
+Run with python -m unittest from the root of the repo."""
+import unittest
+
+from bench import ACTION_LIST_ID, synthetic_models
+from graph import build_action_list
+
+
+class LazyContextTest(unittest.TestCase):
+    def setUp(self):
+        self.models = synthetic_models(groups=20)
+        self.ctx, _ = build_action_list(self.models, ACTION_LIST_ID, lazy=True)
+
+    def assert_missing(self, key):
+        with self.assertRaises(KeyError):
+            self.ctx.actions[key]
+        self.assertIsNone(self.ctx.actions.get(key))
+        self.assertNotIn(key, self.ctx.actions)
+
+    def test_builds_an_action_when_looked_up(self):
+        group_id = max(self.models.groups)
+        action_id = self.models.group_actions[group_id][0].action_id
+        action = self.ctx.actions[(group_id, action_id)]
+        self.assertEqual((action.group_id, action.action_id), (group_id, action_id))
+        self.assertIs(self.ctx.actions.get((group_id, action_id)), action)
+
+    def test_missing_group(self):
+        with self.assertRaises(KeyError):
+            self.ctx.groups[99999]
+        self.assertIsNone(self.ctx.groups.get(99999))
+
+    def test_missing_action_in_a_missing_group(self):
+        self.assert_missing((99999, 99999))
+
+    def test_missing_action_in_an_existing_group(self):
+        self.assert_missing((1, 99999))
+        # The group was built looking for the action
+        self.assertIn(1, self.ctx.groups)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Tests for refreshing Models from a SQLite db standing in for ResWare's db
+
+Run with python -m unittest from the root of the repo."""
+import os
+import tempfile
+import unittest
+
+from bench import ACTION_LIST_ID, synthetic_models
+from database import ResWareDatabaseConnection, SQLiteBackend
+from resware_model import TABLES, GroupAction, Models
+from seed import seed
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "resware.sqlite")
+        seed(synthetic_models(groups=5), path)
+        self.conn = ResWareDatabaseConnection(SQLiteBackend(path)).__enter__()
+        self.addCleanup(self.conn.close)
+
+    def change_db(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE ActionDef SET Name = 'Renamed' WHERE ActionDefID = 100"
+            )
+            cursor.execute(
+                "DELETE FROM ActionListGroupActionDef WHERE ActionListGroupDefID = 1 AND ActionDefID = 101"
+            )
+            cursor.execute(
+                "INSERT INTO ActionListGroupActionDef (ActionListGroupDefID, ActionDefID, Dynamic) VALUES (2, 999, 1)"
+            )
+        self.conn.commit()
+
+    def assert_same_tables(self, models, expected):
+        for name in TABLES:
+            self.assertEqual(getattr(models, name), getattr(expected, name), name)
+
+    def test_reloads_everything_without_change_tracking(self):
+        previous = Models.from_db(self.conn)
+        self.assertIsNone(previous.sync_token)
+        self.change_db()
+        refreshed = previous.refresh(self.conn)
+        self.assertIsNot(refreshed, previous)
+        self.assertIsNone(refreshed.sync_token)
+        self.assert_same_tables(refreshed, Models.from_db(self.conn))
+        self.assertEqual(refreshed.actions[100].name, "Renamed")
+        self.assertNotIn(101, [a.action_id for a in refreshed.group_actions[1]])
+        self.assertIn(GroupAction(2, 999, True), refreshed.group_actions[2])
+
+    def test_leaves_previous_untouched(self):
+        previous = Models.from_db(self.conn)
+        action = previous.actions[100]
+        group_actions = list(previous.group_actions[1])
+        self.change_db()
+        previous.refresh(self.conn)
+        self.assertIs(previous.actions[100], action)
+        self.assertNotEqual(action.name, "Renamed")
+        self.assertEqual(previous.group_actions[1], group_actions)
+
+    def test_reloads_only_the_action_list(self):
+        previous = Models.for_action_list(self.conn, ACTION_LIST_ID)
+        self.change_db()
+        refreshed = previous.refresh(self.conn)
+        self.assertEqual(refreshed.action_list_id, ACTION_LIST_ID)
+        self.assert_same_tables(
+            refreshed, Models.for_action_list(self.conn, ACTION_LIST_ID)
+        )
+        self.assertEqual(refreshed.actions[100].name, "Renamed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,139 @@
-from collections import defaultdict
-import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
 from functools import wraps
-from flask import request, abort, render_template, Flask, Response
+from typing import Optional
+from flask import (
+    request,
+    abort,
+    jsonify,
+    make_response,
+    render_template,
+    Flask,
+    Response,
+)
+from analysis import Closure
+from cache import BytesCache, SingleFlight, StaleWhileRevalidate
 from graph import (
+    ActionList,
+    Context,
+    affected_json,
+    cycles_json,
+    generate_condensed_digraph_from_action_list,
+    find_redundant_affects,
     generate_digraph_from_action_list,
     generate_digraph_from_group,
     build_action_list,
+    leading_to_json,
+    triggers_on,
+)
+from render import (
+    RenderQueueFull,
+    RenderService,
+    RenderTimedOut,
+    graphviz_version,
+)
+from resware_model import Models, build_models, refresh_models
+from settings import (
+    ACTION_LIST_DEF_ID,
+    LAZY_GRAPH,
+    LOAD_ACTION_LIST_ONLY,
+    MODELS_CACHE_TTL,
+    MODELS_SNAPSHOT,
+    PRERENDER,
+    REACH_CLOSURE,
+    RENDER_QUEUE_DEPTH,
+    RENDER_TIMEOUT,
+    RENDER_WORKERS,
+    SVG_CACHE_BYTES,
+    SVG_CACHE_DIR,
+    WEB_TOKEN,
 )
-from resware_model import build_models
-from settings import ACTION_LIST_DEF_ID, WEB_TOKEN
+from snapshot import load_snapshot
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Drawing:
+    """The ways the whole action list's digraph can be simplified, from ?condensed=1 and ?reduced=1
+
+    condensed draws each loop of affects as one node and reduced leaves out the affects that others imply."""
+
+    condensed: bool = False
+    reduced: bool = False
+
+    @classmethod
+    def from_request(cls):
+        return cls(
+            condensed=request.args.get("condensed") == "1",
+            reduced=request.args.get("reduced") == "1",
+        )
+
+
+@dataclass
+class GraphState:
+    """The models loaded from ResWare and the graph built from them, shared by all requests until it's replaced"""
+
+    models: Models
+    ctx: Context
+    alist: ActionList
+    # Identifies the models in ETags, see _models_version
+    version: str
+    # digraph_digest's hashes of the digraphs generated so far by group id, with None for the whole action list, and
+    # Drawing
+    digests: dict = field(default_factory=dict)
+    # find_redundant_affects for ctx, once a reduced Drawing needs it
+    redundant: Optional[set] = None
+    # Closures of ctx.affect_graph forwards and in reverse for the reach endpoints when REACH_CLOSURE is set
+    closure: Optional[Closure] = None
+    reverse_closure: Optional[Closure] = None
+
+
+def _models_version(models, snapshot_stat=None):
+    """A version for models that every process loading the same models agrees on where possible
+
+    That's the snapshot file's modification time and size when loaded from one, or the change tracking version of the
+    database. Backends without change tracking get a random version per load, which only costs cache revalidations."""
+    if snapshot_stat is not None:
+        return f"s{snapshot_stat.st_mtime_ns:x}{snapshot_stat.st_size:x}"
+    if models.sync_token is not None:
+        return f"c{models.sync_token:x}"
+    return uuid.uuid4().hex[:16]
+
+
+def _build_state(previous):
+    snapshot_stat = None
+    if MODELS_SNAPSHOT:
+        snapshot_stat = os.stat(MODELS_SNAPSHOT)
+        models = load_snapshot(MODELS_SNAPSHOT)
+    elif previous is None:
+        models = build_models(ACTION_LIST_DEF_ID if LOAD_ACTION_LIST_ONLY else None)
+    else:
+        models = refresh_models(previous.models)
+    ctx, alist = build_action_list(models, ACTION_LIST_DEF_ID, lazy=LAZY_GRAPH)
+    state = GraphState(
+        models, ctx, alist, version=_models_version(models, snapshot_stat)
+    )
+    if REACH_CLOSURE:
+        state.closure = Closure(ctx.affect_graph)
+        state.reverse_closure = Closure(ctx.affect_graph, reverse=True)
+    if PRERENDER:
+        prerenders.submit(prerender, state).add_done_callback(_log_prerender_failure)
+    return state
+
+
+states = StaleWhileRevalidate(_build_state, MODELS_CACHE_TTL)
 
 
 def auth_required(f):
@@ -23,11 +146,119 @@ def auth_required(f):
     return decorated_function
 
 
-def svg(digraph):
-    run = subprocess.run(
-        ["dot", "-Tsvg"], stdout=subprocess.PIPE, input=bytes(digraph, "utf-8")
-    )
-    return run.stdout
+svgs = BytesCache(SVG_CACHE_BYTES, SVG_CACHE_DIR)
+renderer = RenderService(RENDER_WORKERS, RENDER_QUEUE_DEPTH, RENDER_TIMEOUT)
+
+
+def store_svg(key, rendered):
+    """Caches a rendered SVG along with its gzipped version, so it's only compressed once, and returns the latter"""
+    compressed = gzip.compress(rendered)
+    svgs.put(key, rendered)
+    svgs.put(key + ".gz", compressed)
+    return compressed
+
+
+@contextlib.contextmanager
+def _prerender_lock():
+    # Held while prerendering. When SVG_CACHE_DIR is set, it's shared by every process on the box, so the others wait
+    # for the one prerendering and then find its SVGs cached instead of all rendering the same ones at once
+    if SVG_CACHE_DIR is None:
+        yield
+        return
+    with open(os.path.join(SVG_CACHE_DIR, ".prerender.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _prerender_graph(state, key, group, drawing):
+    # Renders one of prerender's graphs with renderer, so it counts towards RENDER_WORKERS, and as the same flight as a
+    # request for it. Returns False without rendering if it's been cached since prerender checked
+    if svgs.get(key + ".gz") is not None:
+        return False
+    group_id = None if group is None else group.id
+
+    def render():
+        rendered = renderer.render(b"".join(digraph_chunks(state, group, drawing)))
+        store_svg(key, rendered)
+        return rendered
+
+    flights.do((ACTION_LIST_DEF_ID, group_id, drawing, "svg", state.version), render)
+    return True
+
+
+def prerender(state):
+    """Renders the action list and every group in state into svgs, up to RENDER_WORKERS at a time through renderer
+
+    Digraphs whose SVG is already cached are skipped, including ones another process cached first. Progress and timing
+    are logged as it goes."""
+    with _prerender_lock():
+        started_at = time.monotonic()
+        # Each is (group id, drawing), with None for the action list. The groups are looked up by id so a LazyContext
+        # builds all of them
+        groups = [
+            (None, Drawing(condensed, reduced))
+            for condensed, reduced in itertools.product((False, True), repeat=2)
+        ]
+        groups += [(group_id, Drawing()) for group_id in state.models.groups]
+        pending = {}
+        for group_id, drawing in groups:
+            try:
+                group = None if group_id is None else state.ctx.groups[group_id]
+                key = digraph_digest(state, group, drawing) + ".svg"
+            except Exception:
+                # Leave a broken graph to fail its own page instead of stopping the rest from prerendering
+                logger.exception(
+                    "Prerendering %s as %s failed",
+                    "the action list" if group_id is None else f"group {group_id}",
+                    drawing,
+                )
+                continue
+            if svgs.get(key + ".gz") is None:
+                pending[key] = (group, drawing)
+        logger.info(
+            "Prerendering %d of %d graphs, the rest are cached or duplicates. Hashing them took %.3fs",
+            len(pending),
+            len(groups),
+            time.monotonic() - started_at,
+        )
+        rendered = 0
+        with ThreadPoolExecutor(RENDER_WORKERS) as pool:
+            futures = {
+                pool.submit(_prerender_graph, state, key, *g): key
+                for key, g in pending.items()
+            }
+            for finished, future in enumerate(as_completed(futures), 1):
+                try:
+                    rendered += future.result()
+                except RenderQueueFull:
+                    # Requests are keeping dot busy, so leave it for the first one that wants it
+                    logger.info("Skipped prerendering %s, dot is busy", futures[future])
+                except Exception:
+                    logger.exception("Prerendering %s failed", futures[future])
+                if finished % 25 == 0:
+                    logger.info("Prerendered %d of %d graphs", finished, len(futures))
+        logger.info(
+            "Prerendered %d graphs in %.3fs", rendered, time.monotonic() - started_at
+        )
+
+
+def _log_prerender_failure(future):
+    # Nothing waits on prerender's future, so its exception would go unseen otherwise
+    if future.exception() is not None:
+        logger.error("Prerendering failed", exc_info=future.exception())
+
+
+# Runs one prerender at a time so a refresh finishing during a prerender queues the next one behind it
+prerenders = ThreadPoolExecutor(max_workers=1)
+
+
+@app.errorhandler(RenderQueueFull)
+@app.errorhandler(RenderTimedOut)
+def render_unavailable(e):
+    return Response(str(e), status=503, headers={"Retry-After": "10"})
 
 
 def hack_graphviz_svg_for_embed(svg_bytes):
@@ -36,78 +267,246 @@ def hack_graphviz_svg_for_embed(svg_bytes):
     return '<svg width="100%" id="graph"><g>' + svg_str
 
 
-def svg_response(digraph):
-    return Response(svg(digraph), mimetype="image/svg+xml")
+def stream_graphviz_svg_for_embed(chunks):
+    """hack_graphviz_svg_for_embed for an SVG coming in chunks of bytes"""
+    start = b""
+    for chunk in chunks:
+        if start is None:
+            yield chunk
+            continue
+        start += chunk
+        title = start.find(b"<title>")
+        if title >= 0:
+            yield b'<svg width="100%" id="graph"><g>' + start[title:]
+            start = None
+
+
+# Concurrent requests for the same graph share one generation and render of it. Keys are the action list id, the group
+# id or None for the whole action list, the Drawing, the output and the state's version
+flights = SingleFlight()
+
+
+def redundant_affects(state):
+    """find_redundant_affects for state's ctx, found once per state"""
+    if state.redundant is None:
+        state.redundant = flights.do(
+            (ACTION_LIST_DEF_ID, None, None, "redundant", state.version),
+            lambda: find_redundant_affects(state.ctx, state.alist),
+        )
+    return state.redundant
+
+
+def digraph_chunks(state, group=None, drawing=Drawing()):
+    """The digraph for group, or the whole action list drawn as drawing when group is None, as bytes while it's
+    generated"""
+    if group is not None:
+        return generate_digraph_from_group.chunks(state.ctx, group)
+    redundant = redundant_affects(state) if drawing.reduced else frozenset()
+    if drawing.condensed:
+        return generate_condensed_digraph_from_action_list.chunks(
+            state.ctx, state.alist, redundant
+        )
+    return generate_digraph_from_action_list.chunks(state.alist, redundant)
+
+
+def digraph_digest(state, group=None, drawing=Drawing()):
+    """A hash of the Graphviz version and the digraph for group, or the whole action list when group is None
+
+    It's the name of the digraph's SVG in svgs and goes in ETags. It's computed once per state by streaming the digraph
+    through the hash, so the digraph is never held in full."""
+    group_id = None if group is None else group.id
+    digest = state.digests.get((group_id, drawing))
+    if digest is None:
+
+        def generate():
+            sha = hashlib.sha256(graphviz_version())
+            for chunk in digraph_chunks(state, group, drawing):
+                sha.update(chunk)
+            return sha.hexdigest()
+
+        digest = flights.do(
+            (ACTION_LIST_DEF_ID, group_id, drawing, "digest", state.version),
+            generate,
+        )
+        state.digests[(group_id, drawing)] = digest
+    return digest
+
+
+def stream_svg(state, digest, group=None, drawing=Drawing()):
+    """Renders the SVG for a digest that isn't in svgs, yielding it as dot writes it and caching it once dot exits
+
+    The digraph is written to dot as it's generated. This waits for dot's first output before returning, so
+    RenderQueueFull, RenderTimedOut and other failures are raised before a response starts."""
+    key = digest + ".svg"
+
+    def produce(land):
+        # Caches and lands once dot's done, so requests waiting on this one don't wait for its client to download it
+        def rendered(svg):
+            store_svg(key, svg)
+            land(svg)
+
+        return renderer.stream(digraph_chunks(state, group, drawing), rendered=rendered)
+
+    group_id = None if group is None else group.id
+    chunks = flights.stream(
+        (ACTION_LIST_DEF_ID, group_id, drawing, "svg", state.version), produce
+    )
+    return itertools.chain([next(chunks, b"")], chunks)
+
+
+def etag(state, digest, variant):
+    """A strong ETag for a response generated from the digraph with digest
+
+    The models' version covers everything else shown alongside the graph, and variant tells apart the different
+    responses made from the same digraph, since a strong ETag has to identify the exact bytes sent."""
+    return f"{state.version}-{digest[:32]}-{variant}"
+
+
+def not_modified(tag):
+    """Returns a 304 for tag if the request already has it, otherwise None"""
+    if not request.if_none_match.contains(tag):
+        return None
+    response = Response(status=304)
+    response.set_etag(tag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def svg_response(state, group=None, drawing=Drawing()):
+    digest = digraph_digest(state, group, drawing)
+    key = digest + ".svg"
+    gzipped = request.accept_encodings["gzip"] > 0
+    body = svgs.get(key + ".gz") if gzipped else None
+    if body is None:
+        # SVGs streamed from dot aren't compressed
+        gzipped = False
+        body = svgs.get(key)
+    tag = etag(state, digest, "svgz" if gzipped else "svg")
+    unchanged = not_modified(tag)
+    if unchanged is not None:
+        return unchanged
+    if body is None:
+        body = stream_svg(state, digest, group, drawing)
+    response = Response(body, mimetype="image/svg+xml")
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(tag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# Put in graph.html in place of an SVG that's streamed from dot, to split the page around it
+SVG_PLACEHOLDER = "<!-- streamed svg -->"
+
+
+def _page_around(page, svg_chunks):
+    head, tail = page.split(SVG_PLACEHOLDER, 1)
+    yield head.encode("utf-8")
+    yield from stream_graphviz_svg_for_embed(svg_chunks)
+    yield tail.encode("utf-8")
+
+
+def graph_page(state, title, group=None, drawing=Drawing(), **context):
+    """Renders graph.html around the SVG for group, or the whole action list when group is None"""
+    digest = digraph_digest(state, group, drawing)
+    tag = etag(state, digest, "html")
+    unchanged = not_modified(tag)
+    if unchanged is not None:
+        return unchanged
+    rendered = svgs.get(digest + ".svg")
+    if rendered is None:
+        svg_chunks = stream_svg(state, digest, group, drawing)
+        page = render_template(
+            "graph.html", title=title, svg=SVG_PLACEHOLDER, **context
+        )
+        response = Response(_page_around(page, svg_chunks), mimetype="text/html")
+    else:
+        svg_str = hack_graphviz_svg_for_embed(rendered)
+        response = make_response(
+            render_template("graph.html", title=title, svg=svg_str, **context)
+        )
+    response.set_etag(tag)
+    return response
 
 
 @app.route("/")
 @auth_required
 def index():
-    _, alist = build_action_list(build_models(), ACTION_LIST_DEF_ID)
-    return render_template("index.html", groups=alist.groups)
+    return render_template("index.html", groups=states.get().alist.groups)
 
 
 @app.route("/everything.svg")
 @auth_required
 def everything_svg():
-    _, alist = build_action_list(build_models(), ACTION_LIST_DEF_ID)
-    digraph = generate_digraph_from_action_list(alist)
-    return svg_response(digraph)
+    return svg_response(states.get(), drawing=Drawing.from_request())
 
 
 @app.route("/everything")
 @auth_required
 def everything():
-    _, alist = build_action_list(build_models(), ACTION_LIST_DEF_ID)
-    digraph = generate_digraph_from_action_list(alist)
-    svg_str = hack_graphviz_svg_for_embed(svg(digraph))
-    return render_template(
-        "graph.html", title="Everything!", svg=svg_str, incoming={}, outgoing={}
+    return graph_page(
+        states.get(),
+        "Everything!",
+        drawing=Drawing.from_request(),
+        incoming={},
+        outgoing={},
     )
 
 
 @app.route("/groups/<int:group_id>.svg")
 @auth_required
 def group_svg(group_id):
-    ctx, _ = build_action_list(build_models(), ACTION_LIST_DEF_ID)
-    group = ctx.groups[group_id]
-    digraph = generate_digraph_from_group(ctx.groups.values(), group)
-    return svg_response(digraph)
+    state = states.get()
+    return svg_response(state, state.ctx.groups[group_id])
 
 
 @app.route("/groups/<int:group_id>")
 @auth_required
 def group(group_id):
-    ctx, _ = build_action_list(build_models(), ACTION_LIST_DEF_ID)
-    group = ctx.groups[group_id]
-    groups = ctx.groups.values()
+    state = states.get()
+    group = state.ctx.groups[group_id]
+    return graph_page(
+        state,
+        group.name,
+        group,
+        incoming=state.ctx.incoming(group),
+        outgoing=state.ctx.outgoing(group),
+    )
 
-    digraph = generate_digraph_from_group(groups, group)
-    svg_str = hack_graphviz_svg_for_embed(svg(digraph))
 
-    incoming = defaultdict(list)
-    for g in groups:
-        if g == group:
-            continue
-        for act in g.actions:
-            for aff in act.affects:
-                if aff.group == group:
-                    incoming[g].append((act, aff))
-
-    outgoing = defaultdict(list)
-    for act in group.actions:
-        for aff in act.affects:
-            if aff.group != group:
-                outgoing[aff.group].append((act, aff))
-
-    return render_template(
-        "graph.html",
-        title=group.name,
-        svg=svg_str,
-        incoming=incoming,
-        outgoing=outgoing,
-    )
+@app.route("/groups/<int:group_id>/actions/<int:action_id>/reach")
+@auth_required
+def action_reach(group_id, action_id):
+    """What the action eventually causes, or with ?reverse=1 the actions and triggers that eventually lead to it"""
+    state = states.get()
+    action = state.ctx.actions[(group_id, action_id)]
+    if request.args.get("reverse") == "1":
+        return jsonify(
+            leading_to_json(state.ctx, action, state.alist, state.reverse_closure)
+        )
+    return jsonify(affected_json(state.ctx, [action], closure=state.closure))
+
+
+@app.route("/cycles")
+@auth_required
+def action_cycles():
+    """The loops of affects, each as the actions in it"""
+    return jsonify(cycles_json(states.get().ctx))
+
+
+@app.route("/triggers/<int:external_action_id>/reach")
+@auth_required
+def trigger_reach(external_action_id):
+    """What the action list's triggers on the external action eventually cause"""
+    state = states.get()
+    triggers = triggers_on(state.alist, external_action_id)
+    return jsonify(affected_json(state.ctx, triggers=triggers, closure=state.closure))
+
 
+if PRERENDER:
+    # Build the first state at startup instead of on the first request, which also prerenders it. Started last so
+    # everything _build_state and prerender use is defined by the time they run
+    threading.Thread(target=states.get, daemon=True).start()
 
 if __name__ == "__main__":
     app.run(debug=True)